@@ -1,3 +1,7 @@
+# the video encoding worker is forked first, before any thread or device is opened
+import record_ctrl
+record_ctrl.start_record_worker()
+
 # import base_ctrl library
 from base_ctrl import BaseController
 import threading
@@ -21,7 +25,7 @@ else:
 
 try:
     # Use symlink for Secondary Base
-    base2 = BaseController('/dev/base_secondary', 115200)
+    base2 = BaseController('/dev/base_secondary', 115200, peripherals=False)
     print("Secondary base controller connected on /dev/base_secondary")
 except Exception as e:
     base2 = None
@@ -45,7 +49,10 @@ base.base_oled(3, "Starting...")
 from flask import Flask, render_template, Response, request, jsonify, redirect, url_for, send_from_directory, send_file
 from flask_socketio import SocketIO, emit
 from werkzeug.utils import secure_filename
-from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from aiortc.mediastreams import VIDEO_CLOCK_RATE, VIDEO_TIME_BASE
+from av import VideoFrame
+import numpy as np
 import json
 import uuid
 import asyncio
@@ -103,9 +110,6 @@ active_pcs = {}
 # Maximum number of active connections allowed
 MAX_CONNECTIONS = 1
 
-# Set to keep track of RTCPeerConnection instances
-pcs = set()
-
 # Steer Controller
 steer_controller = None
 if SteerController:
@@ -163,6 +167,7 @@ cmd_actions = {
     f['code']['cv_auto']: lambda: cvf.set_cv_mode(f['code']['cv_auto']),
     f['code']['mp_face']: lambda: cvf.set_cv_mode(f['code']['mp_face']),
     f['code']['mp_pose']: lambda: cvf.set_cv_mode(f['code']['mp_pose']),
+    f['code']['cv_fire']: lambda: cvf.set_cv_mode(f['code']['cv_fire']),
 
     f['code']['re_none']: lambda: cvf.set_detection_reaction(f['code']['re_none']),
     f['code']['re_capt']: lambda: cvf.set_detection_reaction(f['code']['re_capt']),
@@ -196,7 +201,8 @@ cmd_feedback_actions = [f['code']['cv_none'], f['code']['cv_moti'],
                         f['code']['cv_face'], f['code']['cv_objs'],
                         f['code']['cv_clor'], f['code']['mp_hand'],
                         f['code']['cv_auto'], f['code']['mp_face'],
-                        f['code']['mp_pose'], f['code']['re_none'],
+                        f['code']['mp_pose'], f['code']['cv_fire'],
+                        f['code']['re_none'],
                         f['code']['re_capt'], f['code']['re_reco'],
                         f['code']['mc_lock'], f['code']['mc_unlo'],
                         f['code']['led_off'], f['code']['led_aut'],
@@ -213,14 +219,26 @@ def process_cv_info(cmd):
 
 # Function to generate video frames from the camera
 def generate_frames():
-    while True:
-        frame = cvf.frame_process()
-        # print(cvf.cv_info())
-        try:
-            yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n') 
-        except Exception as e:
-            print("An [generate_frames] error occurred:", e)
+    cvf.frame_broadcast_start()
+    client_id = uuid.uuid4()
+    frame_seq = 0
+    try:
+        while True:
+            frame_seq, frame = cvf.wait_frame(frame_seq)
+            if frame is None:
+                continue
+            try:
+                # the generator resumes once the server has written the frame
+                write_start = time.time()
+                yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n') 
+                cvf.stream_quality.report_write(client_id, time.time() - write_start, len(frame))
+            except GeneratorExit:
+                raise
+            except Exception as e:
+                print("An [generate_frames] error occurred:", e)
+    finally:
+        cvf.stream_quality.remove_client(client_id)
 
 
 
@@ -286,20 +304,49 @@ def delete_video():
 
 
 # Video WebRTC
+# one persistent event loop serves every peer connection
+webrtc_loop = asyncio.new_event_loop()
+threading.Thread(target=webrtc_loop.run_forever, daemon=True).start()
+
+class PipelineVideoTrack(VideoStreamTrack):
+    """Video track fed by the shared OpencvFuncs frame pipeline."""
+    def __init__(self):
+        super().__init__()
+        self.frame_seq = 0
+        self.last_frame = None
+        self.start_time = None
+
+    async def recv(self):
+        loop = asyncio.get_running_loop()
+        self.frame_seq, frame = await loop.run_in_executor(None, cvf.wait_processed_frame, self.frame_seq)
+        if frame is None:
+            # pipeline stalled, repeat the last frame
+            frame = self.last_frame
+        if frame is None:
+            frame = np.zeros((f['video']['default_res_h'], f['video']['default_res_w'], 3), dtype=np.uint8)
+        self.last_frame = frame
+        video_frame = VideoFrame.from_ndarray(frame, format="bgra" if frame.shape[2] == 4 else "bgr24")
+
+        # timestamps follow the pipeline, not a fixed frame rate
+        if self.start_time is None:
+            self.start_time = time.time()
+        video_frame.pts = int((time.time() - self.start_time) * VIDEO_CLOCK_RATE)
+        video_frame.time_base = VIDEO_TIME_BASE
+        return video_frame
+
 # Function to manage connections
-def manage_connections(pc_id):
-    if len(active_pcs) >= MAX_CONNECTIONS:
+async def manage_connections(pc_id, pc):
+    while len(active_pcs) >= MAX_CONNECTIONS:
         # If maximum connections reached, terminate the oldest connection
         oldest_pc_id = next(iter(active_pcs))
         old_pc = active_pcs.pop(oldest_pc_id)
-        old_pc.close()
+        await old_pc.close()
 
     # Add new connection to active connections
     active_pcs[pc_id] = pc
 
 # Asynchronous function to handle offer exchange
-async def offer_async():
-    params = await request.json
+async def offer_async(params):
     offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
     # Create an RTCPeerConnection instance
@@ -307,27 +354,32 @@ async def offer_async():
 
     # Generate a unique ID for the RTCPeerConnection
     pc_id = "PeerConnection(%s)" % uuid.uuid4()
-    pc_id = pc_id[:8]
 
     # Manage connections
-    manage_connections(pc_id)
+    await manage_connections(pc_id, pc)
 
-    # Create and set the local description
-    await pc.createOffer(offer)
-    await pc.setLocalDescription(offer)
+    @pc.on("connectionstatechange")
+    async def on_connectionstatechange():
+        if pc.connectionState in ("failed", "closed"):
+            if active_pcs.get(pc_id) is pc:
+                active_pcs.pop(pc_id)
+            await pc.close()
 
-    # Prepare the response data with local SDP and type
-    response_data = {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+    pc.addTrack(PipelineVideoTrack())
 
-    return jsonify(response_data)
+    # Answer the browser offer
+    await pc.setRemoteDescription(offer)
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+
+    # Prepare the response data with local SDP and type
+    return {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
 
 # Wrapper function for running the asynchronous offer function
 def offer():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    future = asyncio.run_coroutine_threadsafe(offer_async(), loop)
-    return future.result()
+    cvf.frame_broadcast_start()
+    future = asyncio.run_coroutine_threadsafe(offer_async(request.json), webrtc_loop)
+    return jsonify(future.result(timeout=10))
 
 # set product version
 def set_version(input_main, input_module):
@@ -359,6 +411,9 @@ def cmdline_ctrl(args_string):
                 cvf.show_recv_info(True)
             else:
                 cvf.show_recv_info(False)
+        elif args[1] == '-q' or args[1] == '--queue':
+            print(base.command_status())
+            print(base.feedback_status())
 
     elif args[0] == 'audio':
         if args[1] == '-s' or args[1] == '--say':
@@ -409,6 +464,17 @@ def cmdline_ctrl(args_string):
             cvf.change_target_color(lower_nums, upper_nums)
         elif args[1] == '-s' or args[1] == '--select':
             cvf.selet_target_color(args[2])
+        elif args[1] == '-t' or args[1] == '--timing':
+            print(cvf.cv_stats())
+        elif args[1] == '-d' or args[1] == '--detector':
+            # cv -d cv_moti 2 [priority], rate -1 removes it
+            try:
+                detector_mode = f['code'][args[2]] if args[2] in f['code'] else int(args[2])
+                detector_rate = float(args[3])
+                detector_priority = int(args[4]) if len(args) > 4 else 1
+            except:
+                return
+            cvf.set_cv_detector(detector_mode, detector_rate, detector_priority)
 
     elif args[0] == 'video' or args[0] == 'v':
         if args[1] == '-q' or args[1] == '--quality':
@@ -450,6 +516,15 @@ def cmdline_ctrl(args_string):
             # line -s 0.7 0.8 1.6 0.0006 0.6 0.4 0.2
             cvf.set_line_track_args(float(args[2]), float(args[3]), float(args[4]), float(args[5]), float(args[6]), float(args[7]), float(args[8]))
 
+    elif args[0] == 'photo':
+        # photo -b 10
+        if args[1] == '-b' or args[1] == '--burst':
+            try:
+                int(args[2])
+            except:
+                return
+            cvf.picture_burst(int(args[2]))
+
     elif args[0] == 'track':
         cvf.set_pt_track_args(args[1], args[2])
 
@@ -496,7 +571,7 @@ def cmdline_ctrl(args_string):
         set_version(main_type, module_type)
 
     elif args[0] == 'test':
-        cvf.update_base_data({"T":1003,"mac":1111,"megs":"helllo aaaaaaaa"})
+        base.feedback.publish({"T":1003,"mac":1111,"megs":"helllo aaaaaaaa"})
 
 
 # Route to handle the offer request
@@ -509,6 +584,21 @@ def offer_route():
 def video_feed():
     return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
 
+# Route to stream hardware encoded h264 as fragmented mp4 (csi camera)
+@app.route('/h264_feed')
+def h264_feed():
+    if not cvf.h264_streamer or not cvf.h264_streamer.available():
+        return Response(status=404)
+    return Response(cvf.h264_streamer.generate(), mimetype='video/mp4')
+
+# Route to fetch the current frame without opening a stream
+@app.route('/snapshot.jpg')
+def snapshot():
+    frame = cvf.snapshot()
+    if frame is None:
+        return Response(status=503)
+    return Response(frame, mimetype='image/jpeg', headers={'Cache-Control': 'no-store'})
+
 @app.route('/send_command', methods=['POST'])
 def handle_command():
     command = request.form['command']
@@ -593,8 +683,10 @@ def update_data_websocket_single():
             f['fb']['detect_react']:cvf.detection_reaction_mode,
             f['fb']['pan_angle']:   cvf.pan_angle,
             f['fb']['tilt_angle']:  cvf.tilt_angle,
-            f['fb']['base_voltage']:base.base_data['v'],
+            f['fb']['base_voltage']:base.feedback.value(1001, 'v', 0),
             f['fb']['video_fps']:   cvf.video_fps,
+            f['fb']['stream_quality']: cvf.stream_quality.status(),
+            f['fb']['record_status']: cvf.video_recorder.status(),
             f['fb']['cv_movtion_mode']: cvf.cv_movtion_lock,
             f['fb']['base_light']:  base.base_light_status,
             f['fb']['ir_temp']:     ir_temp_reader.get_temp() if ir_temp_reader else {"ambient_c": 0, "object_c": 0, "ambient_f": 0, "object_f": 0}
@@ -629,21 +721,10 @@ def update_data_loop():
 
 def base_data_loop():
     sensor_interval = 1
-    sensor_read_time = time.time()
     while True:
-        cvf.update_base_data(base.feedback_data())
-
-        # get sensor data
-        if base.extra_sensor:
-            if time.time() - sensor_read_time > sensor_interval:
-                base.rl.read_sensor_data()
-                sensor_read_time = time.time()
-        
-        # get lidar data
-        if base.use_lidar:
-            base.rl.lidar_data_recv()
-        
-        time.sleep(0.025)
+        # get sensor data, the lidar is read by its own thread
+        base.rl.read_sensor_data()
+        time.sleep(sensor_interval)
 
 @socketio.on('message', namespace='/ctrl')
 def handle_socket_cmd(message):
@@ -664,8 +745,9 @@ def handle_socket_cmd(message):
 
 # commandline on boot
 def cmd_on_boot():
+    # set feedback interval, the fastest one the feedback subscribers need
+    base.feedback.negotiate(force=True)
     cmd_list = [
-        'base -c {"T":142,"cmd":50}',   # set feedback interval
         'base -c {"T":131,"cmd":1}',    # serial feedback flow on
         'base -c {"T":143,"cmd":0}',    # serial echo off
         'base -c {{"T":4,"cmd":{}}}'.format(f['base_config']['module_type']),      # select the module - 0:None 1:RoArm-M2-S 2:Gimbal
@@ -703,9 +785,15 @@ if __name__ == "__main__":
     data_update_thread = threading.Thread(target=update_data_loop, daemon=True)
     data_update_thread.start()
 
-    # base data update
-    base_update_thread = threading.Thread(target=base_data_loop, daemon=True)
-    base_update_thread.start()
+    # base feedback subscribers, esp-now messages as they come,
+    # the chassis status once per telemetry update
+    base.feedback.subscribe(lambda slot: cvf.update_espnow_megs(slot.data), types=(1003,))
+    base.feedback.subscribe(None, types=(1001,), interval=1000)
+
+    # sensor data update
+    if base.extra_sensor:
+        base_update_thread = threading.Thread(target=base_data_loop, daemon=True)
+        base_update_thread.start()
 
     # lights off
     base.lights_ctrl(0, 0)
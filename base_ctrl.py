@@ -6,22 +6,68 @@ import yaml
 import os
 import time
 import glob
+import math
+import itertools
 import numpy as np
+from collections import deque, namedtuple
 
 curpath = os.path.realpath(__file__)
 thisPath = os.path.dirname(curpath)
 with open(thisPath + '/config.yaml', 'r') as yaml_file:
     f = yaml.safe_load(yaml_file)
 
+# legacy lidar frame, 47 bytes little endian
+lidar_points_per_frame = 12
+lidar_frame_dtype = np.dtype([
+	('header', 'u1'),
+	('verlen', 'u1'),
+	('speed', '<u2'),
+	('start_angle', '<u2'),
+	('points', [('distance', '<u2'), ('confidence', 'u1')], (lidar_points_per_frame,)),
+	('end_angle', '<u2'),
+	('timestamp', '<u2'),
+	('crc', 'u1'),
+])
+
+
+def decode_lidar_frames(buf):
+	# every frame in a chunk of lidar bytes, found by the 0x54 header and the
+	# 0x2c ver/len byte, returns the frames and how many bytes were used up
+	size = lidar_frame_dtype.itemsize
+	data = np.frombuffer(buf, dtype=np.uint8)
+	if len(data) < size:
+		return np.zeros(0, lidar_frame_dtype), 0
+	candidates = np.flatnonzero((data[:-size+1] == 0x54) & (data[1:len(data)-size+2] == 0x2c))
+	# frames do not overlap, a header byte inside a frame is data
+	starts = []
+	next_start = 0
+	for start in candidates.tolist():
+		if start >= next_start:
+			starts.append(start)
+			next_start = start + size
+	if not starts:
+		# the tail may hold the start of the next frame
+		return np.zeros(0, lidar_frame_dtype), len(data) - size + 1
+	frames = data[np.array(starts)[:, None] + np.arange(size)].view(lidar_frame_dtype)[:, 0]
+	return frames, next_start
+
+
 class ReadLine:
-	def __init__(self, s):
-		self.buf = bytearray()
+	def __init__(self, s, peripherals=True, buffer_size=4096):
+		# bulk reads land in a fixed buffer, lines are framed in place
+		self.buf = bytearray(buffer_size)
+		self.view = memoryview(self.buf)
+		self.start = 0
+		self.end = 0
+		self.overflows = 0
 		self.s = s
 
 		self.sensor_data = []
 		self.sensor_list = []
+		# the extra sensor and the lidar are opened by the primary controller only,
+		# a second reader on the same port would split its byte stream
 		self.sensor_data_ser = None
-		if f['base_config']['extra_sensor']:
+		if peripherals and f['base_config']['extra_sensor']:
 			try:
 				self.sensor_data_ser = serial.Serial(glob.glob('/dev/ttyUSB*')[0], 115200)
 				print("/dev/ttyUSB* connected succeed")
@@ -30,39 +76,49 @@ class ReadLine:
 		self.sensor_data_max_len = 51
 
 		self.lidar_ser = None
-		if f['base_config']['use_lidar']:
+		if peripherals and f['base_config']['use_lidar']:
 			try:
 				self.lidar_ser = serial.Serial(glob.glob('/dev/ttyACM*')[0], 230400, timeout=1)
 				print("/dev/ttyACM* connected succeed")
 			except:
 				self.lidar_ser = None
-		self.ANGLE_PER_FRAME = 12
-		self.HEADER = 0x54
-		self.lidar_angles = []
-		self.lidar_distances = []
-		self.lidar_angles_show = []
-		self.lidar_distances_show = []
+		# the last full revolution, angles in radians and distances as flat arrays
+		self.lidar_scan = (np.zeros(0), np.zeros(0, np.uint16))
 		self.last_start_angle = 0
-
-	def readline(self):
-		i = self.buf.find(b"\n")
-		if i >= 0:
-			r = self.buf[:i+1]
-			self.buf = self.buf[i+1:]
-			return r
-		while True:
-			i = max(1, min(512, self.s.in_waiting))
-			data = self.s.read(i)
-			i = data.find(b"\n")
-			if i >= 0:
-				r = self.buf + data[:i+1]
-				self.buf[0:] = data[i+1:]
-				return r
+		if self.lidar_ser is not None:
+			self.lidar_thread = threading.Thread(target=self.lidar_data_loop, daemon=True)
+			self.lidar_thread.start()
+
+	# fill() and next_line() belong to the BaseController reader thread,
+	# other threads get complete messages from BaseController.feedback
+	def fill(self):
+		# one read of everything waiting, blocks for the first byte up to the port timeout
+		if self.end == len(self.buf):
+			if self.start == 0:
+				# no newline in a full buffer, garbage on the line
+				self.overflows += 1
+				self.end = 0
 			else:
-				self.buf.extend(data)
-
-	def clear_buffer(self):
-		self.s.reset_input_buffer()
+				# moves the partial line to the front
+				size = self.end - self.start
+				self.view[:size] = self.view[self.start:self.end]
+				self.start, self.end = 0, size
+		size = min(max(1, self.s.in_waiting), len(self.buf) - self.end)
+		count = self.s.readinto(self.view[self.end:self.end+size]) or 0
+		self.end += count
+		return count
+
+	def next_line(self):
+		# the next complete line without the newline, a view into the buffer
+		# that is only valid until the next fill(), None if there is none
+		i = self.buf.find(b"\n", self.start, self.end)
+		if i < 0:
+			return None
+		line = self.view[self.start:i]
+		self.start = i + 1
+		if self.start == self.end:
+			self.start = self.end = 0
+		return line
 
 	def read_sensor_data(self):
 		if self.sensor_data_ser == None:
@@ -85,105 +141,404 @@ class ReadLine:
 		except Exception as e:
 			print(f"[base_ctrl.read_sensor_data] error: {e}")
 
-	def parse_lidar_frame(self, data):
-		# header = data[0]
-		# verlen = data[1]
-		# speed  = data[3] << 8 | data[2]
-		start_angle = (data[5] << 8 | data[4]) * 0.01
-		# print(start)
-		# end_angle = (data[43] << 8 | data[42]) * 0.01
-		for i in range(0, self.ANGLE_PER_FRAME):
-			offset = 6 + i * 3
-			distance = data[offset+1] << 8 | data[offset]
-			confidence = data[offset+2]
-			# lidar_angles.append(np.radians(start_angle + i * 0.167))
-			self.lidar_angles.append(np.radians(start_angle + i * 0.83333 + 180))
-			# lidar_angles.append(np.radians(start_angle + end_angle))
-			self.lidar_distances.append(distance)
-		# end_angle = (data[43] << 8 | data[42]) * 0.01
-		# timestamp = data[45] << 8 | data[44]
-		# crc = data[46]
-		return start_angle
-
-	def lidar_data_recv(self):
-		if self.lidar_ser == None:
-			return
-		try:
-			while True:
-				self.header = self.lidar_ser.read(1)
-				if self.header == b'\x54':
-					# Read the rest of the data
-					data = self.header + self.lidar_ser.read(46)
-					hex_data = [int(hex(byte), 16) for byte in data]
-					start_angle = self.parse_lidar_frame(hex_data)
-					if self.last_start_angle > start_angle:
-						break
-					self.last_start_angle = start_angle
+	def lidar_data_loop(self):
+		pending = b''
+		angles = []
+		distances = []
+		while True:
+			try:
+				chunk = self.lidar_ser.read(max(lidar_frame_dtype.itemsize * 10, self.lidar_ser.in_waiting))
+			except Exception as e:
+				print(f"[base_ctrl.lidar_data_loop] error: {e}")
+				time.sleep(1)
+				try:
+					self.lidar_ser = serial.Serial(glob.glob('/dev/ttyACM*')[0], 230400, timeout=1)
+				except Exception:
+					pass
+				pending = b''
+				continue
+
+			buf = pending + chunk
+			frames, consumed = decode_lidar_frames(buf)
+			pending = buf[consumed:]
+			if not len(frames):
+				continue
+
+			start_angles = frames['start_angle'] * 0.01
+			frame_angles = np.radians(start_angles[:, None] + np.arange(lidar_points_per_frame) * 0.83333 + 180)
+			frame_distances = frames['points']['distance']
+
+			# a revolution ends where the start angle wraps around
+			previous = np.concatenate(([self.last_start_angle], start_angles[:-1]))
+			begin = 0
+			for wrap in np.flatnonzero(start_angles < previous):
+				angles.append(frame_angles[begin:wrap])
+				distances.append(frame_distances[begin:wrap])
+				self.lidar_scan = (np.concatenate(angles).ravel(), np.concatenate(distances).ravel())
+				angles = []
+				distances = []
+				begin = wrap
+			angles.append(frame_angles[begin:])
+			distances.append(frame_distances[begin:])
+			self.last_start_angle = start_angles[-1]
+
+
+# prebuilt encodings of the hot commands, the fields in the order the senders use
+command_templates = {
+	1: (('T', 'L', 'R'), '{"T":1,"L":%s,"R":%s}\n'),
+	13: (('T', 'X', 'Z'), '{"T":13,"X":%s,"Z":%s}\n'),
+	132: (('T', 'IO4', 'IO5'), '{"T":132,"IO4":%s,"IO5":%s}\n'),
+	133: (('T', 'X', 'Y', 'SPD', 'ACC'), '{"T":133,"X":%s,"Y":%s,"SPD":%s,"ACC":%s}\n'),
+}
+
+
+def encode_number(value):
+	# the same text json.dumps writes, None when the template does not apply
+	if isinstance(value, int) and not isinstance(value, bool):
+		return int.__repr__(value)
+	if isinstance(value, float) and math.isfinite(value):
+		return float.__repr__(value)
+	return None
+
+
+def encode_command(data):
+	# compact json, every byte is about 87us at 115200 baud
+	template = command_templates.get(data.get('T'))
+	if template is not None and tuple(data) == template[0]:
+		values = tuple(encode_number(data[key]) for key in template[0][1:])
+		if None not in values:
+			return (template[1] % values).encode('utf-8')
+	return (json.dumps(data, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class CommandQueue:
+	"""Commands waiting for the serial port. Motion, gimbal and light
+	commands are latest-wins: a newer command of the same type and target
+	replaces the pending one in place. Stops go through a priority lane
+	in front of everything else."""
+	coalesce_types = (1, 13, 132, 133)
+	# the wheel (T:1) and ros (T:13) commands both drive the chassis
+	chassis_types = (1, 13)
+	# pending commands an emergency stop makes obsolete
+	motion_types = (1, 13, 133)
+
+	def __init__(self):
+		self.cond = threading.Condition()
+		# stops by lane key, a newer stop replaces the pending one
+		self.priority = {}
+		self.order = deque()
+		self.pending = {}
+		self.sequence = itertools.count()
+		self.sent = 0
+		self.coalesced = 0
+		self.dropped = 0
+
+	@staticmethod
+	def key(data):
+		t = data.get('T')
+		if t in CommandQueue.coalesce_types:
+			return (t, data.get('id'))
+		return None
+
+	@staticmethod
+	def is_priority(data):
+		t = data.get('T')
+		if t == 0:
+			return True
+		if t == 1:
+			return data.get('L') == 0 and data.get('R') == 0
+		if t == 13:
+			return data.get('X') == 0 and data.get('Z') == 0
+		return False
+
+	def put(self, data):
+		with self.cond:
+			if self.is_priority(data):
+				t = data.get('T')
+				# a chassis stop of either type cancels every pending chassis command
+				obsolete_types = self.motion_types if t == 0 else self.chassis_types
+				obsolete = [key for key in self.pending if key[0] in obsolete_types]
+				for key in obsolete:
+					del self.pending[key]
+					self.dropped += 1
+				lane = 0 if t == 0 else 'chassis'
+				if self.priority.pop(lane, None) is not None:
+					self.coalesced += 1
+				self.priority[lane] = data
+			else:
+				key = self.key(data)
+				if key is None:
+					# not coalesced, a unique key keeps it in the fifo
+					key = (None, next(self.sequence))
+					self.order.append(key)
+				elif key in self.pending:
+					self.coalesced += 1
 				else:
-					self.lidar_ser.flushInput()
-
-			self.last_start_angle = start_angle
-			self.lidar_angles_show = self.lidar_angles.copy()
-			self.lidar_distances_show = self.lidar_distances.copy()
-			self.lidar_angles.clear()
-			self.lidar_distances.clear()
-		except Exception as e:
-			print(f"[base_ctrl.lidar_data_recv] error: {e}")
-			self.lidar_ser = serial.Serial(glob.glob('/dev/ttyACM*')[0], 230400, timeout=1)
+					self.order.append(key)
+				self.pending[key] = data
+			self.cond.notify()
+
+	def get_all(self):
+		# everything pending at once, waits for the first command
+		with self.cond:
+			while not self.priority and not self.pending:
+				self.cond.wait()
+			commands = list(self.priority.values())
+			self.priority.clear()
+			for key in self.order:
+				data = self.pending.pop(key, None)
+				if data is not None:
+					commands.append(data)
+			self.order.clear()
+			self.sent += len(commands)
+			return commands
+
+	def depth(self):
+		with self.cond:
+			return len(self.priority) + len(self.pending)
+
+	def status(self):
+		with self.cond:
+			return {'depth': len(self.priority) + len(self.pending), 'sent': self.sent,
+					'coalesced': self.coalesced, 'dropped': self.dropped}
+
+
+# the latest message of one feedback type, seq counts every message received
+FeedbackSlot = namedtuple('FeedbackSlot', ['data', 'time', 'seq'])
+
+
+class FeedbackSubscription:
+	def __init__(self, callback, types, interval):
+		# None only declares the interval, for consumers reading the slots
+		self.callback = callback
+		# None for every type
+		self.types = types
+		# ms, how often the subscriber needs its types, None when it does not care
+		self.interval = interval
+		# last delivery time by type
+		self.last_time = {}
+
+
+class FeedbackHub:
+	"""Feedback routed by T (1001 chassis status, 1003 esp-now message, ...)
+	into latest-value slots. Subscribers are called on the parser thread
+	with the slot, at most once per their interval. The base is asked
+	(T:142) for the fastest interval any subscriber needs."""
+	def __init__(self, set_interval, min_interval=50, max_interval=1000):
+		self.set_interval = set_interval
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.interval = None
+		self.cond = threading.Condition()
+		self.slots = {}
+		self.seq = 0
+		self.subscriptions = []
+
+	def publish(self, data):
+		now = time.time()
+		t = data['T']
+		with self.cond:
+			self.seq += 1
+			slot = FeedbackSlot(data, now, self.seq)
+			self.slots[t] = slot
+			subscriptions = self.subscriptions
+			self.cond.notify_all()
+		for subscription in subscriptions:
+			if subscription.callback is None or (subscription.types is not None and t not in subscription.types):
+				continue
+			if subscription.interval and (now - subscription.last_time.get(t, 0)) * 1000 < subscription.interval:
+				continue
+			subscription.last_time[t] = now
+			try:
+				subscription.callback(slot)
+			except Exception as e:
+				print(f"[base_ctrl.FeedbackHub.publish] error: {e}")
+
+	def latest(self, t):
+		return self.slots.get(t)
+
+	def value(self, t, key, default=None):
+		slot = self.slots.get(t)
+		if slot is None:
+			return default
+		return slot.data.get(key, default)
+
+	def wait(self, t=None, timeout=1):
+		# the next message of type t, any type for None
+		with self.cond:
+			seq = self.seq
+			if t is None:
+				self.cond.wait_for(lambda: self.seq != seq, timeout)
+				return max(self.slots.values(), key=lambda slot: slot.seq, default=None)
+			self.cond.wait_for(lambda: t in self.slots and self.slots[t].seq > seq, timeout)
+			return self.slots.get(t)
+
+	def subscribe(self, callback, types=None, interval=None):
+		subscription = FeedbackSubscription(callback, types, interval)
+		with self.cond:
+			# replaced, not changed in place, publish() iterates without the lock
+			self.subscriptions = self.subscriptions + [subscription]
+		self.negotiate()
+		return subscription
+
+	def unsubscribe(self, subscription):
+		with self.cond:
+			self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+		self.negotiate()
+
+	def negotiate(self, force=False):
+		intervals = [s.interval for s in self.subscriptions if s.interval]
+		interval = min(intervals) if intervals else self.max_interval
+		interval = int(min(max(interval, self.min_interval), self.max_interval))
+		if interval != self.interval or force:
+			self.interval = interval
+			self.set_interval(interval)
+
+	def status(self):
+		return {'interval': self.interval, 'subscriptions': len(self.subscriptions),
+				'seq': {t: slot.seq for t, slot in self.slots.items()}}
 
 
 class BaseController:
 
-	def __init__(self, uart_dev_set, buad_set):
+	def __init__(self, uart_dev_set, buad_set, peripherals=True):
 		self.ser = serial.Serial(uart_dev_set, buad_set, timeout=1)
-		self.rl = ReadLine(self.ser)
-		self.command_queue = queue.Queue()
+		self.rl = ReadLine(self.ser, peripherals)
+		self.command_queue = CommandQueue()
+		# 8N1, ten bits on the wire per byte
+		self.link_capacity = buad_set / 10
+		self.bytes_written = 0
+		self.write_count = 0
+		self.link_rate = 0
+		self.link_window_start = time.time()
+		self.link_window_bytes = 0
 		self.command_thread = threading.Thread(target=self.process_commands, daemon=True)
 		self.command_thread.start()
 
 		self.base_light_status = 0
 		self.head_light_status = 0
 
-		self.data_buffer = None
-		self.base_data = None
-
-		self.use_lidar = f['base_config']['use_lidar']
-		self.extra_sensor = f['base_config']['extra_sensor']
+		self.use_lidar = peripherals and f['base_config']['use_lidar']
+		self.extra_sensor = peripherals and f['base_config']['extra_sensor']
+
+		# feedback, framed by the reader thread and parsed by the parser thread
+		self.feedback_queue = queue.Queue(maxsize=256)
+		self.feedback = FeedbackHub(self.set_feedback_interval, f['base_config']['feedback_min_interval'], f['base_config']['feedback_max_interval'])
+		self.feedback_count = 0
+		self.feedback_errors = 0
+		self.feedback_dropped = 0
+		self.reader_thread = threading.Thread(target=self.read_feedback, daemon=True)
+		self.reader_thread.start()
+		self.parser_thread = threading.Thread(target=self.parse_feedback, daemon=True)
+		self.parser_thread.start()
 		
 
-	def feedback_data(self):
-		try:
-			while self.rl.s.in_waiting > 0:
-				self.data_buffer = json.loads(self.rl.readline().decode('utf-8'))
-				if 'T' in self.data_buffer:
-					self.base_data = self.data_buffer
-					self.data_buffer = None
-					if self.base_data["T"] == 1003:
-						print(self.base_data)
-						return self.base_data
-			self.rl.clear_buffer()
-			self.data_buffer = json.loads(self.rl.readline().decode('utf-8'))
-			self.base_data = self.data_buffer
-			return self.base_data
-		except Exception as e:
-			self.rl.clear_buffer()
-			print(f"[base_ctrl.feedback_data] error: {e}")
+	def read_feedback(self):
+		while True:
+			try:
+				if not self.rl.fill():
+					continue
+			except Exception as e:
+				print(f"[base_ctrl.read_feedback] error: {e}")
+				time.sleep(1)
+				continue
+			while True:
+				line = self.rl.next_line()
+				if line is None:
+					break
+				if len(line) < 2:
+					continue
+				# the only copy, the buffer is reused by the next read
+				line = bytes(line)
+				while True:
+					try:
+						self.feedback_queue.put_nowait(line)
+						break
+					except queue.Full:
+						# the parser fell behind, the oldest message goes
+						try:
+							self.feedback_queue.get_nowait()
+							self.feedback_dropped += 1
+						except queue.Empty:
+							pass
+
+
+	def parse_feedback(self):
+		while True:
+			line = self.feedback_queue.get()
+			try:
+				data = json.loads(line)
+			except ValueError:
+				self.feedback_errors += 1
+				continue
+			if not isinstance(data, dict) or 'T' not in data:
+				self.feedback_errors += 1
+				continue
+			self.feedback_count += 1
+			self.feedback.publish(data)
+
 
+	def feedback_data(self, t=1001):
+		# the latest message of type t, does not wait
+		slot = self.feedback.latest(t)
+		return slot.data if slot else None
 
-	def on_data_received(self):
-		self.ser.reset_input_buffer()
-		data_read = json.loads(self.rl.readline().decode('utf-8'))
-		return data_read
+
+	def on_data_received(self, t=None, timeout=1):
+		# waits for the next message
+		slot = self.feedback.wait(t, timeout)
+		return slot.data if slot else None
+
+
+	def set_feedback_interval(self, interval):
+		self.send_command({"T":142,"cmd":interval})
+
+
+	def feedback_status(self):
+		status = {'received': self.feedback_count, 'errors': self.feedback_errors,
+				  'dropped': self.feedback_dropped, 'overflows': self.rl.overflows}
+		status.update(self.feedback.status())
+		return status
 
 
 	def send_command(self, data):
 		self.command_queue.put(data)
 
 
+	def command_status(self):
+		# queue depth, sent, coalesced (replaced by a newer one) and dropped (by a stop) counts,
+		# bytes written and the link load against the baud rate
+		status = self.command_queue.status()
+		link_rate = self.link_rate
+		elapsed = time.time() - self.link_window_start
+		if elapsed >= 2:
+			# nothing written for a while, the last full window is stale
+			link_rate = self.link_window_bytes / elapsed
+		status.update({'bytes': self.bytes_written, 'writes': self.write_count,
+					   'bytes_per_sec': round(link_rate), 'link_load': round(link_rate / self.link_capacity, 3)})
+		return status
+
+
 	def process_commands(self):
 		while True:
-			data = self.command_queue.get()
-			self.ser.write((json.dumps(data) + '\n').encode("utf-8"))
+			# one write per wakeup for whatever piled up meanwhile
+			payload = b''.join(encode_command(data) for data in self.command_queue.get_all())
+			try:
+				self.ser.write(payload)
+			except Exception as e:
+				print(f"[base_ctrl.process_commands] error: {e}")
+			self.update_link_rate(len(payload))
+
+
+	def update_link_rate(self, size):
+		self.bytes_written += size
+		self.write_count += 1
+		self.link_window_bytes += size
+		now = time.time()
+		if now - self.link_window_start >= 1:
+			self.link_rate = self.link_window_bytes / (now - self.link_window_start)
+			self.link_window_start = now
+			self.link_window_bytes = 0
 
 
 	def base_json_ctrl(self, input_json):
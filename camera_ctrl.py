@@ -0,0 +1,334 @@
+import cv2
+import subprocess
+import threading
+import time
+import numpy as np
+
+# libraries for csi camera
+try:
+    from picamera2 import Picamera2
+except ImportError:
+    Picamera2 = None
+
+# libraries for oak camera
+try:
+    import depthai as dai
+except ImportError:
+    dai = None
+
+
+class CameraGrabber():
+    """Acquisition thread for one camera backend, only the newest frame
+    and its capture time are kept, older frames are dropped. fps caps the
+    read rate, 0 reads as fast as the source delivers."""
+    def __init__(self, width=640, height=480, fps=0):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_time = 0
+        self.frame_seq = 0
+        self.frame_seq_read = 0
+        self.dropped_frames = 0
+        self.connected = False
+        self.running = False
+        self.thread = None
+
+        # reconnect backoff in seconds
+        self.reconnect_min = 0.5
+        self.reconnect_max = 8
+        self.reconnect_delay = self.reconnect_min
+
+    def open(self):
+        raise NotImplementedError
+
+    def read(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=2.0)
+        self.close()
+        self.connected = False
+
+    def connect(self):
+        try:
+            self.connected = bool(self.open())
+        except Exception as e:
+            print(f"[camera_ctrl.{type(self).__name__}.connect] error: {e}")
+            self.connected = False
+        return self.connected
+
+    def run(self):
+        next_time = time.time()
+        while self.running:
+            if not self.connected:
+                if not self.connect():
+                    time.sleep(self.reconnect_delay)
+                    self.reconnect_delay = min(self.reconnect_delay * 2, self.reconnect_max)
+                    continue
+                self.reconnect_delay = self.reconnect_min
+
+            if self.fps:
+                # fixed pacing before the read, a late frame does not make the next one early
+                next_time = max(next_time + 1 / self.fps, time.time() - 1 / self.fps)
+                time.sleep(max(0, next_time - time.time()))
+
+            try:
+                frame = self.read()
+            except Exception as e:
+                print(f"[camera_ctrl.{type(self).__name__}.run] error: {e}")
+                frame = None
+            # stamped as soon as the capture returns
+            frame_time = time.time()
+
+            if frame is None:
+                # device lost, reconnect in the background
+                self.close()
+                self.connected = False
+                continue
+
+            with self.condition:
+                if self.frame is not None and self.frame_seq_read != self.frame_seq:
+                    self.dropped_frames += 1
+                self.frame = frame
+                self.frame_time = frame_time
+                self.frame_seq += 1
+                self.condition.notify_all()
+
+    def latest(self):
+        # returns (seq, capture_time, frame) without waiting
+        with self.condition:
+            self.frame_seq_read = self.frame_seq
+            return self.frame_seq, self.frame_time, self.frame
+
+    def wait_frame(self, last_seq, timeout=1.0):
+        # waits for a frame newer than last_seq, never on the device itself
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_seq != last_seq, timeout)
+            self.frame_seq_read = self.frame_seq
+            return self.frame_seq, self.frame_time, self.frame
+
+
+class UsbCameraGrabber(CameraGrabber):
+    def __init__(self, index=0, width=640, height=480, fps=0):
+        super().__init__(width, height, fps)
+        self.index = index
+        self.camera = None
+
+    def open(self):
+        self.camera = cv2.VideoCapture(self.index)
+        if not self.camera.isOpened():
+            self.camera.release()
+            self.camera = None
+            return False
+        self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        # keep the driver queue short, we only want the newest frame
+        self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return True
+
+    def read(self):
+        success, frame = self.camera.read()
+        if not success:
+            return None
+        return frame
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+
+
+class CsiCameraGrabber(CameraGrabber):
+    def __init__(self, width=640, height=480, fps=0):
+        super().__init__(width, height, fps)
+        self.picam2 = None
+
+    def open(self):
+        if Picamera2 is None:
+            return False
+        if self.picam2 is None:
+            self.picam2 = Picamera2()
+            self.picam2.configure(self.picam2.create_video_configuration(main={"format": 'XRGB8888', "size": (self.width, self.height)}))
+        self.picam2.start()
+        return True
+
+    def read(self):
+        return self.picam2.capture_array()
+
+    def close(self):
+        if self.picam2 is not None:
+            try:
+                self.picam2.stop()
+            except Exception as e:
+                print(f"[camera_ctrl.CsiCameraGrabber.close] error: {e}")
+
+
+class OakCameraGrabber(CameraGrabber):
+    def __init__(self, width=640, height=480, fps=0):
+        super().__init__(width, height, fps)
+        self.device = None
+        self.output_queue = None
+
+    def open(self):
+        if dai is None:
+            return False
+        pipeline = dai.Pipeline()
+
+        camRgb = pipeline.createColorCamera()
+        camRgb.setBoardSocket(dai.CameraBoardSocket.RGB)
+        camRgb.setInterleaved(False)
+        # camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_480_P)
+        camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_720_P)
+
+        xout = pipeline.createXLinkOut()
+        xout.setStreamName("video")
+        camRgb.video.link(xout.input)
+
+        self.device = dai.Device(pipeline)
+        self.output_queue = self.device.getOutputQueue(name="video", maxSize=1, blocking=False)
+        return True
+
+    def read(self):
+        packet = self.output_queue.get()
+        if packet is None:
+            return None
+        return cv2.resize(packet.getCvFrame(), (self.width, self.height))
+
+    def close(self):
+        if self.device is not None:
+            try:
+                self.device.close()
+            except Exception as e:
+                print(f"[camera_ctrl.OakCameraGrabber.close] error: {e}")
+            self.device = None
+            self.output_queue = None
+
+
+class FileCameraGrabber(CameraGrabber):
+    """Replays a video file as if it was a camera, looping at the end.
+    Without an fps setting the file's own frame rate is used."""
+    def __init__(self, filename, width=640, height=480, fps=0, loop=True):
+        super().__init__(width, height, fps)
+        self.filename = filename
+        self.loop = loop
+        self.camera = None
+
+    def open(self):
+        self.camera = cv2.VideoCapture(self.filename)
+        if not self.camera.isOpened():
+            self.camera.release()
+            self.camera = None
+            return False
+        if not self.fps:
+            self.fps = self.camera.get(cv2.CAP_PROP_FPS) or 30
+        return True
+
+    def read(self):
+        success, frame = self.camera.read()
+        if not success and self.loop:
+            self.camera.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            success, frame = self.camera.read()
+        if not success:
+            # end of file, stop the thread instead of reopening the file
+            if not self.loop:
+                self.running = False
+            return None
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv2.resize(frame, (self.width, self.height))
+        return frame
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.release()
+            self.camera = None
+
+
+class SyntheticCameraGrabber(CameraGrabber):
+    """Generated test frames: a fixed gradient, a moving square and the
+    frame number. The same seq always gives the same image."""
+    def __init__(self, width=640, height=480, fps=30):
+        super().__init__(width, height, fps)
+        self.background = None
+        self.count = 0
+
+    def open(self):
+        x = np.linspace(0, 255, self.width, dtype=np.uint8)
+        y = np.linspace(0, 255, self.height, dtype=np.uint8)
+        self.background = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.background[:, :, 0] = x[np.newaxis, :]
+        self.background[:, :, 1] = y[:, np.newaxis]
+        self.background[:, :, 2] = 128
+        self.count = 0
+        return True
+
+    def read(self):
+        frame = self.background.copy()
+        size = self.height // 6
+        x = int((self.count * 4) % (self.width - size))
+        y = int((self.height - size) / 2 * (1 + np.sin(self.count / 20)))
+        cv2.rectangle(frame, (x, y), (x + size, y + size), (255, 255, 255), -1)
+        cv2.putText(frame, str(self.count), (10, self.height - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1)
+        self.count += 1
+        return frame
+
+
+def usb_camera_detection():
+    try:
+        lsusb_output = subprocess.check_output(["lsusb"]).decode("utf-8")
+    except Exception as e:
+        print(f"[camera_ctrl.usb_camera_detection] error: {e}")
+        return False
+    if "Camera" in lsusb_output:
+        print("USB Camera connected")
+        return True
+    else:
+        print("USB Camera not connected")
+        return False
+
+
+def create_camera(video_config):
+    """Picks the camera backend from the video section of config.yaml,
+    camera_source: auto, usb, csi, oak, file or synthetic. auto keeps
+    the old order usb - csi - oak. Returns (source name, grabber) or
+    (None, None), the grabber is not started yet."""
+    source = video_config.get('camera_source', 'auto')
+    width, height = video_config['default_res_w'], video_config['default_res_h']
+    fps = video_config.get('camera_fps', 0)
+
+    if source == 'file':
+        return 'file', FileCameraGrabber(video_config['camera_file'], width, height, fps, video_config.get('camera_loop', True))
+    if source == 'synthetic':
+        return 'synthetic', SyntheticCameraGrabber(width, height, fps or 30)
+
+    # usb camera init
+    if source == 'usb' or (source == 'auto' and usb_camera_detection()):
+        return 'usb', UsbCameraGrabber(0, width, height, fps)
+
+    # csi camera init
+    if source in ('auto', 'csi'):
+        print("init csi camera.")
+        csi_camera = CsiCameraGrabber(width, height, fps)
+        if csi_camera.connect():
+            return 'csi', csi_camera
+
+    #oak camera init
+    if source in ('auto', 'oak'):
+        oak_camera = OakCameraGrabber(width, height, fps)
+        if oak_camera.connect():
+            return 'oak', oak_camera
+
+    return None, None
@@ -1,22 +1,28 @@
 import cv2
 import imutils
 import mediapipe as mp
-import imageio
 import threading
 import datetime, time
 import numpy as np
 import math
-import yaml, os, json, subprocess
-from collections import deque
+import yaml, os, json
+from collections import deque, namedtuple
 import textwrap
 
-# libraries for csi camera
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder, Encoder
-from picamera2.outputs import FfmpegOutput
-
-# libraries for oak camera
-import depthai as dai
+# camera acquisition threads
+import camera_ctrl
+# overlay compositing
+import overlay_ctrl
+# hardware h264 streaming
+import stream_ctrl
+# background video recording
+import record_ctrl
+# shared per-frame preprocessing
+import preprocess_ctrl
+# yolov8 fire and smoke detection
+import fire_ctrl
+# tracking between detector frames
+import track_ctrl
 
 # config file.
 curpath = os.path.realpath(__file__)
@@ -25,14 +31,440 @@ with open(thisPath + '/config.yaml', 'r') as yaml_file:
     f = yaml.safe_load(yaml_file)
 
 
+class FrameBroadcaster():
+    """One producer thread publishes encoded frames into a shared slot,
+    any number of consumers wait on the condition for the next sequence."""
+    def __init__(self, producer, keep_alive=None, idle_timeout=2):
+        self.producer = producer
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_seq = 0
+        self.last_read_time = time.time()
+        self.last_encoded_read_time = 0
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def touch(self, encoded=True):
+        self.last_read_time = time.time()
+        if encoded:
+            self.last_encoded_read_time = self.last_read_time
+
+    def wants_encoded(self):
+        # somebody reads the jpeg frames, not only the raw ones
+        return time.time() - self.last_encoded_read_time < self.idle_timeout
+
+    def is_idle(self):
+        if self.keep_alive and self.keep_alive():
+            return False
+        return time.time() - self.last_read_time > self.idle_timeout
+
+    def run(self):
+        while True:
+            # nobody is watching and nothing needs the pipeline, release the cpu
+            if self.is_idle():
+                time.sleep(0.05)
+                continue
+            try:
+                frame = self.producer()
+            except Exception as e:
+                print(f"[cv_ctrl.FrameBroadcaster.run] error: {e}")
+                time.sleep(0.1)
+                continue
+            with self.condition:
+                self.frame = frame
+                self.frame_seq += 1
+                self.condition.notify_all()
+
+    def wait_frame(self, last_seq, timeout=1.0, encoded=True):
+        # returns (seq, frame), the frame is newer than last_seq unless timed out
+        with self.condition:
+            self.touch(encoded)
+            self.condition.wait_for(lambda: self.frame_seq != last_seq, timeout)
+            return self.frame_seq, self.frame
+
+
+def frame_zoom(input_frame, scale_rate):
+    if scale_rate == 1:
+        return input_frame
+    img_height, img_width = input_frame.shape[:2]
+    img_width_d2  = img_width/2
+    img_height_d2 = img_height/2
+    x_start = int(img_width_d2 - (img_width_d2//scale_rate))
+    x_end   = int(img_width_d2 + (img_width_d2//scale_rate))
+    y_start = int(img_height_d2 - (img_height_d2//scale_rate))
+    y_end   = int(img_height_d2 + (img_height_d2//scale_rate))
+    return input_frame[y_start:y_end, x_start:x_end]
+
+
+class JpegCache():
+    """Keeps the latest processed frame and its jpeg bytes, each
+    (frame sequence, quality, zoom scale) is encoded only once."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+        self.frame_seq = 0
+        self.frame_time = 0
+        self.entries = {}
+
+    def update(self, frame_seq, frame):
+        # the frame must not be drawn on after it was handed over
+        with self.lock:
+            self.frame = frame
+            self.frame_seq = frame_seq
+            self.frame_time = time.time()
+            self.entries = {}
+
+    def latest(self):
+        with self.lock:
+            return self.frame_seq, self.frame
+
+    def get(self, quality, scale_rate=1, out_scale=1):
+        with self.lock:
+            frame, frame_seq = self.frame, self.frame_seq
+            key = (frame_seq, quality, scale_rate, out_scale)
+            jpeg = self.entries.get(key)
+        if jpeg is not None or frame is None:
+            return jpeg
+        out_frame = frame_zoom(frame, scale_rate)
+        if out_scale != 1:
+            out_frame = cv2.resize(out_frame, None, fx=out_scale, fy=out_scale, interpolation=cv2.INTER_AREA)
+        ret, buffer = cv2.imencode('.jpg', out_frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        jpeg = buffer.tobytes()
+        with self.lock:
+            if self.frame_seq == frame_seq:
+                self.entries[key] = jpeg
+        return jpeg
+
+
+class StreamQualityController():
+    """Adapts jpeg quality, output resolution and frame skipping to the
+    time clients need to take each frame and to the pipeline fps.
+    Degrades quality first, then resolution, then frame rate, and
+    recovers in the reverse order once the link has been quiet."""
+    def __init__(self, max_quality):
+        self.enabled = f['video']['adaptive_quality']
+        self.max_latency = f['video']['stream_max_latency']
+        self.max_bandwidth = f['video']['stream_max_bandwidth']
+        self.min_quality = f['video']['stream_min_quality']
+        self.min_fps = f['video']['stream_min_fps']
+        self.max_quality = max_quality
+        self.scale_levels = [1, 0.75, 0.5]
+        self.max_skip = 4
+
+        self.quality = max_quality
+        self.scale_index = 0
+        self.frame_skip = 1
+        self.decision = 'hold'
+
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.decision_interval = 1
+        self.decision_time = time.time()
+        self.quiet_intervals = 0
+
+    @property
+    def out_scale(self):
+        return self.scale_levels[self.scale_index]
+
+    def set_max_quality(self, max_quality):
+        self.max_quality = max_quality
+        self.quality = max_quality
+        self.scale_index = 0
+        self.frame_skip = 1
+
+    def report_write(self, client_id, write_time, nbytes):
+        # called by every stream client after a frame has been written
+        with self.lock:
+            stats = self.clients.setdefault(client_id, [0, 0, 0, 0])
+            stats[0] += write_time
+            stats[1] += nbytes
+            stats[2] += 1
+            stats[3] = time.time()
+
+    def remove_client(self, client_id):
+        with self.lock:
+            self.clients.pop(client_id, None)
+
+    def link_pressure(self, interval):
+        # worst client, 1.0 means exactly at the latency or bandwidth target
+        pressure = 0
+        now = time.time()
+        with self.lock:
+            for client_id in list(self.clients):
+                write_sum, byte_sum, count, last_time = self.clients[client_id]
+                if now - last_time > 5:
+                    # a client that stopped writing for seconds is stalled or gone
+                    self.clients.pop(client_id)
+                    continue
+                self.clients[client_id] = [0, 0, 0, last_time]
+                if not count:
+                    continue
+                pressure = max(pressure, write_sum / count / self.max_latency)
+                if self.max_bandwidth:
+                    pressure = max(pressure, byte_sum / interval / self.max_bandwidth)
+        return pressure
+
+    def degrade(self):
+        if self.quality > self.min_quality:
+            self.quality = max(self.min_quality, int(self.quality * 0.7))
+            return 'quality down'
+        if self.scale_index < len(self.scale_levels) - 1:
+            self.scale_index += 1
+            return 'resolution down'
+        if self.frame_skip < self.max_skip:
+            self.frame_skip += 1
+            return 'skip up'
+        return 'at minimum'
+
+    def recover(self):
+        if self.frame_skip > 1:
+            self.frame_skip -= 1
+            return 'skip down'
+        if self.scale_index > 0:
+            self.scale_index -= 1
+            return 'resolution up'
+        if self.quality < self.max_quality:
+            self.quality = min(self.max_quality, self.quality + 5)
+            return 'quality up'
+        return 'hold'
+
+    def update(self, pipeline_fps):
+        # called once per processed frame, decides once per interval
+        now = time.time()
+        interval = now - self.decision_time
+        if not self.enabled or interval < self.decision_interval:
+            return
+        self.decision_time = now
+        pressure = self.link_pressure(interval)
+        fps_low = pipeline_fps and pipeline_fps < self.min_fps
+        # hysteresis, recovery needs the fps clearly above the minimum, otherwise a
+        # slow camera or cv load would flip the resolution back and forth
+        fps_recovered = not pipeline_fps or pipeline_fps >= self.min_fps * 1.25
+        if pressure > 1:
+            self.quiet_intervals = 0
+            self.decision = self.degrade()
+        elif fps_low and pressure > 0 and self.scale_index < len(self.scale_levels) - 1:
+            # the pipeline itself is too slow, a smaller frame is cheaper to encode
+            self.quiet_intervals = 0
+            self.scale_index += 1
+            self.decision = 'resolution down (fps)'
+        elif pressure < 0.5 and not fps_recovered:
+            self.quiet_intervals = 0
+            self.decision = 'hold (fps)'
+        elif pressure < 0.5:
+            self.quiet_intervals += 1
+            # recover slowly, one step every few quiet seconds
+            if self.quiet_intervals >= 3:
+                self.quiet_intervals = 0
+                self.decision = self.recover()
+        else:
+            self.quiet_intervals = 0
+            self.decision = 'hold'
+
+    def status(self):
+        return {'q': self.quality, 'scale': self.out_scale, 'skip': self.frame_skip, 'decision': self.decision}
+
+
+# a cv result and the frame it was computed from
+CvResult = namedtuple('CvResult', ['seq', 'frame_time', 'mode', 'overlay', 'process_time'])
+
+
+class CvWorker():
+    """One long-lived thread runs every enabled detector. The inbox holds a
+    single frame, a newer frame replaces one that was not picked up yet.
+    Each detector has a target rate (0 runs on every frame) and a priority
+    (lower runs first); detectors that are due run in that order until the
+    per-frame cpu budget is spent. Gated detectors only run when the
+    change gate sees a change, or every force_interval seconds. A detector
+    with every > 1 runs on every Nth frame only, track(mode, frame_ctx)
+    carries its results over the frames in between. Every result is tagged
+    with the seq and capture time of its frame and passed to the listeners."""
+    def __init__(self, process, frame_budget=0.1, max_wait=1.0, change_gate=None, force_interval=5.0, track=None):
+        # process(mode, frame_ctx) returns the overlay of that frame
+        self.process = process
+        # track(mode, frame_ctx) returns the overlay between detections, or None
+        self.track = track
+        self.frame_budget = frame_budget
+        # a detector skipped for this long runs regardless of the budget
+        self.max_wait = max_wait
+        self.change_gate = change_gate or preprocess_ctrl.ChangeGate()
+        self.force_interval = force_interval
+        self.condition = threading.Condition()
+        self.inbox = None
+        self.detectors = {}
+        self.results = {}
+        self.listeners = []
+        self.replaced_frames = 0
+        self.timing = {}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def enable(self, mode, rate=0, priority=0, gated=False, every=1):
+        with self.condition:
+            last_run = self.detectors[mode]['last_run'] if mode in self.detectors else 0
+            self.detectors[mode] = {'rate': rate, 'priority': priority, 'gated': gated, 'every': every,
+                                    'frames': every, 'last_run': last_run, 'last_pass': 0}
+
+    def disable(self, mode):
+        with self.condition:
+            self.detectors.pop(mode, None)
+            self.results.pop(mode, None)
+
+    def active(self):
+        return bool(self.detectors)
+
+    def submit(self, seq, frame_time, frame):
+        # the pipeline keeps drawing on its frame, the worker gets a copy
+        with self.condition:
+            if self.inbox is not None:
+                self.replaced_frames += 1
+            self.inbox = (seq, frame_time, frame.copy())
+            self.condition.notify()
+
+    def due_detectors(self, now):
+        with self.condition:
+            for d in self.detectors.values():
+                d['frames'] += 1
+            detectors = dict(self.detectors)
+        due = [mode for mode, d in detectors.items()
+               if (not d['rate'] or now - d['last_run'] >= 1 / d['rate']) and d['frames'] >= d['every']]
+        # by priority, the longest waiting first within one priority
+        due.sort(key=lambda mode: (detectors[mode]['priority'], detectors[mode]['last_run']))
+        return due
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.inbox is not None)
+                seq, frame_time, frame = self.inbox
+                self.inbox = None
+            # gray, hsv, downscaled levels etc. are computed once for all detectors
+            frame_ctx = preprocess_ctrl.FrameContext(frame, seq, frame_time)
+            frame_ctx.change_regions = None
+            spent = 0
+            now = time.time()
+            ran = set()
+            for mode in self.due_detectors(now):
+                if self.gate_closed(mode, frame_ctx, now):
+                    continue
+                # skip what does not fit into the budget, the first detector always runs
+                cost = self.timing[mode]['avg'] if mode in self.timing else 0
+                starving = now - self.detectors.get(mode, {}).get('last_run', now) > self.max_wait
+                if spent and spent + cost > self.frame_budget and not starving:
+                    if mode in self.timing:
+                        self.timing[mode]['skip'] += 1
+                    continue
+                start_time = time.time()
+                try:
+                    overlay = self.process(mode, frame_ctx)
+                except Exception as e:
+                    print(f"[cv_ctrl.CvWorker.run] error: {e}")
+                    overlay = None
+                process_time = time.time() - start_time
+                spent += process_time
+                self.add_timing(mode, process_time)
+                result = CvResult(seq, frame_time, mode, overlay, process_time)
+                with self.condition:
+                    if mode not in self.detectors:
+                        continue
+                    self.detectors[mode]['last_run'] = start_time
+                    self.detectors[mode]['last_pass'] = start_time
+                    self.detectors[mode]['frames'] = 0
+                    self.results[mode] = result
+                ran.add(mode)
+                self.publish(result)
+            if self.track is not None:
+                self.track_others(frame_ctx, ran)
+
+    def track_others(self, frame_ctx, ran):
+        # detectors that did not run on this frame move their boxes with the tracker
+        with self.condition:
+            modes = [mode for mode in self.detectors if mode not in ran]
+        for mode in modes:
+            start_time = time.time()
+            try:
+                overlay = self.track(mode, frame_ctx)
+            except Exception as e:
+                print(f"[cv_ctrl.CvWorker.track_others] error: {e}")
+                continue
+            if overlay is None:
+                continue
+            result = CvResult(frame_ctx.seq, frame_ctx.frame_time, mode, overlay, time.time() - start_time)
+            with self.condition:
+                if mode in self.detectors:
+                    self.results[mode] = result
+            self.publish(result)
+
+    def add_listener(self, listener):
+        # listener(result) runs on the worker thread for every detector and track result
+        self.listeners.append(listener)
+
+    def publish(self, result):
+        for listener in self.listeners:
+            try:
+                listener(result)
+            except Exception as e:
+                print(f"[cv_ctrl.CvWorker.publish] error: {e}")
+
+    def gate_closed(self, mode, frame_ctx, now):
+        detector = self.detectors.get(mode)
+        if detector is None or not detector['gated'] or now - detector['last_pass'] >= self.force_interval:
+            return False
+        # the gate runs once per frame, shared by every gated detector
+        if frame_ctx.change_regions is None:
+            frame_ctx.change_regions = self.change_gate.check(frame_ctx)
+        if frame_ctx.change_regions:
+            return False
+        # unchanged scene, the last result still holds for this frame
+        with self.condition:
+            detector['last_run'] = now
+            if mode in self.results:
+                self.results[mode] = self.results[mode]._replace(seq=frame_ctx.seq, frame_time=frame_ctx.frame_time)
+        if mode in self.timing:
+            self.timing[mode]['gated'] += 1
+        return True
+
+    def add_timing(self, mode, process_time):
+        timing = self.timing.setdefault(mode, {'n': 0, 'avg': process_time, 'max': 0, 'last': 0, 'skip': 0, 'gated': 0})
+        timing['n'] += 1
+        timing['avg'] = 0.9 * timing['avg'] + 0.1 * process_time
+        timing['max'] = max(timing['max'], process_time)
+        timing['last'] = process_time
+
+    def latest(self, frame_time, max_age):
+        # fresh results of the enabled detectors, the highest priority last so it is drawn on top
+        with self.condition:
+            detectors = dict(self.detectors)
+            results = dict(self.results)
+        fresh = []
+        for mode, result in results.items():
+            if mode not in detectors:
+                continue
+            rate = detectors[mode]['rate']
+            if frame_time - result.frame_time <= max(max_age, 2 / rate if rate else 0):
+                fresh.append(result)
+        fresh.sort(key=lambda result: -detectors[result.mode]['priority'])
+        return fresh
+
+    def stats(self):
+        # per mode processing time in ms
+        return {mode: {'n': t['n'], 'avg': round(t['avg'] * 1000, 1), 'max': round(t['max'] * 1000, 1),
+                       'last': round(t['last'] * 1000, 1), 'skip': t['skip'], 'gated': t['gated']} for mode, t in self.timing.items()}
+
+
 class OpencvFuncs():
     """docstring for OpencvFuncs"""
     def __init__(self, project_path, base_ctrl, lidar_ctrl=None, gimbal_ctrl=None):
         self.base_ctrl = base_ctrl
         self.lidar_ctrl = lidar_ctrl
         self.gimbal_ctrl = gimbal_ctrl
-        self.cv_event = threading.Event()
-        self.cv_event.clear()
         self.cv_mode = f['code']['cv_none']
         self.detection_reaction_mode = f['code']['re_none']
         
@@ -41,12 +473,20 @@ class OpencvFuncs():
         self.video_path = self.this_path + '/templates/videos/'
         self.frame_scale = 1
         self.picture_capture_flag = False
+        # callbacks of every request merged into the pending capture
+        self.picture_captured_callbacks = []
+        self.picture_capture_lock = threading.Lock()
+        self.burst_remaining = 0
+        self.burst_frames = []
+        self.photo_writer = record_ctrl.PhotoWriter(self.photo_path)
         self.set_video_record_flag = False
         self.video_record_status_flag = False
-        self.writer = None
-        self.overlay = None
         self.scale_rate = 1
         self.video_quality = f['video']['default_quality']
+        self.picture_quality = 95
+        self.stream_quality = StreamQualityController(self.video_quality)
+        self.processed_seq = 0
+        self.jpeg_cache = JpegCache()
 
         # cv ctrl info
         self.cv_light_mode = 0
@@ -73,6 +513,12 @@ class OpencvFuncs():
         self.faceCascade = cv2.CascadeClassifier(thisPath + '/models/haarcascade_frontalface_default.xml')
         self.min_radius = f['cv']['min_radius']
         self.track_faces_iterate = f['cv']['track_faces_iterate']
+        # face sizes in full frame pixels, a tracked face is searched for near its last position
+        self.face_min_size = f['cv']['face_min_size']
+        self.face_max_size = f['cv']['face_max_size']
+        self.face_scale_factor = f['cv']['face_scale_factor']
+        self.face_full_every = f['cv']['face_full_every']
+        self.face_passes = 0
 
         # color detection
         self.points = deque(maxlen=32)
@@ -96,6 +542,15 @@ class OpencvFuncs():
                             "dog", "horse", "motorbike", "person", "pottedplant", "sheep",
                             "sofa", "train", "tvmonitor"]
 
+        # cv_fire, the onnx model is loaded on first use
+        self.fire_detector = fire_ctrl.FireDetector(thisPath + '/' + f['cv']['fire_model'], f['cv']['fire_classes'],
+                                                    f['cv']['fire_input_size'], f['cv']['fire_conf'], f['cv']['fire_iou'])
+        self.fire_alarm_classes = f['cv']['fire_alarm_classes']
+        # full resolution tiles for small flames, as many as fit into the budget
+        self.fire_tiles = f['cv']['fire_tiles']
+        self.fire_tile_budget = f['cv']['fire_tile_budget']
+        self.fire_tile_overlap = f['cv']['fire_tile_overlap']
+
         # mediapipe
         self.mpDraw = mp.solutions.drawing_utils
 
@@ -131,6 +586,7 @@ class OpencvFuncs():
 
         # base data
         self.show_base_info_flag = False
+        self.recv_subscription = None
         self.recv_deque = deque(maxlen=20)
 
         # info update
@@ -148,163 +604,167 @@ class OpencvFuncs():
         # osd settings
         self.add_osd = f['base_config']['add_osd']
 
-        # camera type detection
-        self.usb_camera_connected = self.usb_camera_detection()
-        self.csi_camera_connected = False
-        self.oak_camera_connected = False
-
-        # usb camera init
-        if self.usb_camera_connected:
-            self.camera = cv2.VideoCapture(0)
-            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, f['video']['default_res_w'])
-            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, f['video']['default_res_h'])
-
-        # csi camera init
-        if not self.usb_camera_connected:
-            print("init csi camera.")
-            try:
-                self.encoder = H264Encoder(1000000)
-                self.picam2 = Picamera2()
-                self.picam2.configure(self.picam2.create_video_configuration(main={"format": 'XRGB8888', "size": (f['video']['default_res_w'], f['video']['default_res_h'])}))
-                self.picam2.start()
-                self.csi_camera_connected = True
-            except:
-                self.csi_camera_connected = False
-
-        #oak camera init 
-        if not self.usb_camera_connected and not self.csi_camera_connected:
-            try:
-                self.pipeline = dai.Pipeline()
-
-                self.camRgb = self.pipeline.createColorCamera()
-                self.camRgb.setBoardSocket(dai.CameraBoardSocket.RGB)
-                self.camRgb.setInterleaved(False)
-                # self.camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_480_P)
-                self.camRgb.setResolution(dai.ColorCameraProperties.SensorResolution.THE_720_P)
-
-                self.xout = self.pipeline.createXLinkOut()
-                self.xout.setStreamName("video")
-                self.camRgb.video.link(self.xout.input)
-
-                self.device = dai.Device(self.pipeline)
-                self.output_queue = self.device.getOutputQueue(name="video", maxSize=8, blocking=False)
-
-                self.oak_camera_connected = True
-            except Exception as e:
-                print(f"[cv_ctrl.frame_process] error: {e}")
-                self.oak_camera_connected = False
-
+        # cv modes run on one persistent worker, results older than this are not drawn
+        change_gate = preprocess_ctrl.ChangeGate(f['cv']['gate_scale'], f['cv']['gate_threshold'], f['cv']['gate_min_area'])
+        self.cv_worker = CvWorker(self.cv_process, f['cv']['frame_budget'],
+                                  change_gate=change_gate, force_interval=f['cv']['gate_force_interval'],
+                                  track=self.cv_track)
+        # age of each mode's results when they come out, capture to overlay
+        self.cv_latency = {}
+        self.cv_worker.add_listener(self.cv_result_received)
+        # expensive detectors only run after the change gate saw something
+        self.cv_gated_modes = [f['code'][mode_name] for mode_name in f['cv']['gated_modes']]
+        # tracked detectors run every Nth frame, the tracker moves their boxes in between
+        self.cv_track_every = f['cv']['track_every']
+        self.cv_trackers = {f['code'][mode_name]: track_ctrl.MultiTracker(f['cv']['track_iou'], f['cv']['track_max_age'],
+                                                                          f['cv']['track_min_hits'], f['cv']['track_cv_tracker'])
+                            for mode_name in f['cv']['tracked_modes']}
+        self.track_overlays = {}
+        self.cv_overlay_max_age = f['cv']['overlay_max_age']
+        # the input resolution each detector works on, as a fraction of the frame
+        self.cv_input_scale = {f['code'][mode_name]: scale for mode_name, scale in f['cv']['input_scale'].items()}
+
+        # frame broadcast, one pipeline thread shared by every video client
+        self.frame_broadcaster = FrameBroadcaster(self.frame_process, self.pipeline_keep_alive)
+
+        # camera backend from config, see camera_ctrl.create_camera
+        # every backend runs its own acquisition thread
+        self.camera_source, self.camera = camera_ctrl.create_camera(f['video'])
+        self.camera_frame_seq = 0
+        self.camera_timeout = 1.0
+        self.csi_camera_connected = self.camera_source == 'csi'
+        if self.csi_camera_connected:
+            self.picam2 = self.camera.picam2
+
+        if self.camera:
+            self.camera.start()
+
+        # hardware h264 live stream, csi camera only, the one encoder is
+        # shared with hardware recording at the higher of both bitrates
+        self.h264_encoder = None
+        self.h264_streamer = None
+        if self.csi_camera_connected:
+            h264_bitrate = f['video']['h264_bitrate']
+            if f['video']['record_hw_encoder']:
+                h264_bitrate = max(h264_bitrate, f['video']['record_hw_bitrate'])
+            self.h264_encoder = stream_ctrl.SharedH264Encoder(self.picam2, h264_bitrate)
+            self.h264_streamer = stream_ctrl.H264Streamer(self.h264_encoder)
+
+        # video recording runs in its own process, or on the h264 encoder for csi cameras
+        record_h264_encoder = self.h264_encoder if f['video']['record_hw_encoder'] else None
+        self.video_recorder = record_ctrl.VideoRecorder(f['video']['record_fps'], h264_encoder=record_h264_encoder)
+
+        # the seconds before a detection triggered recording
+        self.pre_event_seconds = f['video']['pre_event_seconds']
+        self.pre_event_quality = f['video']['pre_event_quality']
+        self.pre_event_buffer = record_ctrl.PreEventBuffer(self.pre_event_seconds, f['video']['pre_event_max_mb'] * 1024 * 1024)
+
+
+    def camera_failed_frame(self, text):
+        input_frame = 255 * np.ones((480, 640, 3), dtype=np.uint8)
+        cv2.putText(input_frame, f"camera read failed... \n{text}", 
+                    (round(0.05*640), round(0.1*640 + 5 * 13)), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.369, (0, 0, 0), 1)
+        ret, buffer = cv2.imencode('.jpg', input_frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.video_quality])
+        return buffer.tobytes()
 
     def frame_process(self):
         try:
-            if self.usb_camera_connected:
-                success, input_frame = self.camera.read()
-                if not success:
-                    self.camera.release()
-                    time.sleep(1)
-                    self.camera = cv2.VideoCapture(0)
-            elif self.csi_camera_connected:
-                input_frame = self.picam2.capture_array()
-            elif self.oak_camera_connected:
-                input_frame = self.output_queue.get().getCvFrame()
-                input_frame = cv2.resize(input_frame, (640, 480))
-            else:
-                input_frame = 255 * np.ones((480, 640, 3), dtype=np.uint8)
-                cv2.putText(input_frame, f"camera read failed... \nusb - csi - oak", 
-                            (round(0.05*640), round(0.1*640 + 5 * 13)), 
-                            cv2.FONT_HERSHEY_SIMPLEX, 0.369, (0, 0, 0), 1)
-                ret, buffer = cv2.imencode('.jpg', input_frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.video_quality])
-                input_frame = buffer.tobytes()
+            if self.camera is None:
                 time.sleep(1)
-                return input_frame
+                return self.camera_failed_frame("usb - csi - oak")
+            # only waits on the acquisition thread, stale frames are skipped there
+            self.camera_frame_seq, frame_time, input_frame = self.camera.wait_frame(self.camera_frame_seq, self.camera_timeout)
+            if input_frame is None or time.time() - frame_time > self.camera_timeout:
+                return self.camera_failed_frame("reconnecting...")
         except Exception as e:
             print(f"[cv_ctrl.frame_process] error: {e}")
-            input_frame = 255 * np.ones((480, 640, 3), dtype=np.uint8)
-            cv2.putText(input_frame, f"camera read failed... \n{e}", 
-                        (round(0.05*640), round(0.1*640 + 5 * 13)), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.369, (0, 0, 0), 1)
-            ret, buffer = cv2.imencode('.jpg', input_frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.video_quality])
-            input_frame = buffer.tobytes()
-            return input_frame
+            return self.camera_failed_frame(e)
 
         # opencv funcs
-        if self.cv_mode != f['code']['cv_none']:
-            if not self.cv_event.is_set():
-                self.cv_event.set()
-                self.opencv_threading(input_frame)
+        if self.cv_worker.active():
+            self.cv_worker.submit(self.camera_frame_seq, frame_time, input_frame)
             try:
-                mask = self.overlay.astype(bool)
-                input_frame[mask] = self.overlay[mask]
-                cv2.addWeighted(self.overlay, 1, input_frame, 1, 0, input_frame)
+                # the overlays of every detector merged onto one frame
+                for cv_result in self.cv_worker.latest(frame_time, self.cv_overlay_max_age):
+                    if cv_result.overlay is not None:
+                        cv_result.overlay.render(input_frame)
             except Exception as e:
                     print("An error occurred:", e)
         elif self.show_info_flag:
             if time.time() - self.info_update_time > self.info_show_time:
                 self.show_info_flag = False
-            self.overlay = input_frame.copy()
-            cv2.rectangle(self.overlay,  (round((self.info_scale-0.005)*640), round((0.33)*480)), 
+            overlay_ctrl.blend_rect(input_frame, (round((self.info_scale-0.005)*640), round((0.33)*480)), 
                                     (round(0.98*640), round((0.78)*480)), 
-                                    self.info_bg_color, -1)
-            cv2.addWeighted(self.overlay, 0.5, input_frame, 0.5, 0, input_frame)
+                                    self.info_bg_color, 0.5)
 
             # info_deque.appendleft(time.time())
+            # every line is a cached sprite, only new lines are rendered with putText
             for i in range(0, len(self.info_deque)):
-                cv2.putText(input_frame, str(self.info_deque[i]['text']), 
+                overlay_ctrl.draw_text(input_frame, str(self.info_deque[i]['text']), 
                             (round(self.info_scale*640), round(self.info_scale*640 - i * 20)), 
-                            cv2.FONT_HERSHEY_SIMPLEX, self.info_deque[i]['size'], self.info_deque[i]['color'], 1)
+                            self.info_deque[i]['size'], self.info_deque[i]['color'], 1)
 
         if self.show_base_info_flag:
-            for i in range(0, len(self.recv_deque)):
-                cv2.putText(input_frame, str(self.recv_deque[i]), 
-                        (round(0.05*640), round(0.1*640 + i * 13)), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.369, (255, 255, 255), 1)
+            overlay_ctrl.draw_text_lines(input_frame, list(self.recv_deque), 
+                        (round(0.05*640), round(0.1*640)), 
+                        0.369, (255, 255, 255), 1, 13)
 
         # render osd
         input_frame = self.osd_render(input_frame)
 
-        # capture frame
-        if self.picture_capture_flag:
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            photo_filename = f'{self.photo_path}photo_{current_time}.jpg'
-            try:
-                cv2.imwrite(photo_filename, input_frame)
-                self.picture_capture_flag = False
-                print(photo_filename)
-            except:
-                pass
-
         # record video
         if not self.set_video_record_flag and not self.video_record_status_flag:
             pass
         elif self.set_video_record_flag and not self.video_record_status_flag:
             current_time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
             video_filename = f'{self.video_path}video_{current_time}.mp4'
-            self.writer = imageio.get_writer(video_filename, fps=30)
+            self.video_recorder.start(video_filename, input_frame.shape, self.pre_event_buffer.drain())
             self.video_record_status_flag = True
         elif self.set_video_record_flag and self.video_record_status_flag:
             cv2.circle(input_frame, (15, 15), 5, (64, 64, 255), -1)
-            self.writer.append_data(np.array(cv2.cvtColor(input_frame, cv2.COLOR_BGRA2RGB)))
+            # hands the frame to the recorder process, dropped if it falls behind
+            self.video_recorder.append(input_frame, frame_time)
         elif not self.set_video_record_flag and self.video_record_status_flag:
             self.video_record_status_flag = False
-            self.writer.close()
+            self.video_recorder.stop()
 
-        # frame scale
-        if self.scale_rate == 1:
-            pass
-        else:
-            img_height, img_width = input_frame.shape[:2]
-            img_width_d2  = img_width/2
-            img_height_d2 = img_height/2
-            x_start = int(img_width_d2 - (img_width_d2//self.scale_rate))
-            x_end   = int(img_width_d2 + (img_width_d2//self.scale_rate))
-            y_start = int(img_height_d2 - (img_height_d2//self.scale_rate))
-            y_end   = int(img_height_d2 + (img_height_d2//self.scale_rate))
-            input_frame = input_frame[y_start:y_end, x_start:x_end]
-
-        # encode frame
+        # the frame is final from here on, every jpeg is encoded from the cache
+        self.processed_seq += 1
+        self.jpeg_cache.update(self.processed_seq, input_frame)
+
+        # buffer the last seconds while a detection may start a recording
+        if (self.detection_reaction_mode == f['code']['re_reco'] and not self.video_record_status_flag
+                and self.video_recorder.h264_encoder is None):
+            self.pre_event_buffer.push(self.jpeg_cache.get(self.pre_event_quality), frame_time)
+
+        # capture frame, the photo writer thread does the sd card i/o
+        if self.picture_capture_flag:
+            with self.picture_capture_lock:
+                self.picture_capture_flag = False
+                callbacks = self.picture_captured_callbacks
+                self.picture_captured_callbacks = []
+            self.photo_writer.save(self.jpeg_cache.get(self.picture_quality), frame_time)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"[cv_ctrl.picture_capture] error: {e}")
+
+        # burst, kept in memory at full rate and written afterwards
+        if self.burst_remaining > 0:
+            self.burst_frames.append((frame_time, self.jpeg_cache.get(self.picture_quality)))
+            self.burst_remaining -= 1
+            if self.burst_remaining == 0:
+                self.photo_writer.save_burst(self.burst_frames)
+                self.burst_frames = []
+
+        # encode frame, skipped while only raw or h264 consumers are attached
         try:
-            ret, buffer = cv2.imencode('.jpg', input_frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.video_quality])
-            input_frame = buffer.tobytes()
+            if self.frame_broadcaster.wants_encoded() and self.processed_seq % self.stream_quality.frame_skip == 0:
+                input_frame = self.jpeg_cache.get(self.stream_quality.quality, self.scale_rate, self.stream_quality.out_scale)
+            else:
+                input_frame = None
         except:
             pass
 
@@ -314,28 +774,49 @@ class OpencvFuncs():
             self.video_fps = self.fps_count/2
             self.fps_count = 0
             self.fps_start_time = time.time()
+        self.stream_quality.update(self.video_fps)
 
         # output frame
         return input_frame
 
 
 
-    def usb_camera_detection(self):
-        lsusb_output = subprocess.check_output(["lsusb"]).decode("utf-8")
-        if "Camera" in lsusb_output:
-            print("USB Camera connected")
-            return True
-        else:
-            print("USB Camera not connected")
-            return False
+    def pipeline_keep_alive(self):
+        # cv reactions and recordings have to keep running without viewers
+        return (self.cv_worker.active() or
+                self.set_video_record_flag or self.video_record_status_flag or
+                self.picture_capture_flag or self.burst_remaining > 0)
 
+    def frame_broadcast_start(self):
+        self.frame_broadcaster.start()
+
+    def wait_frame(self, last_seq, timeout=1.0):
+        return self.frame_broadcaster.wait_frame(last_seq, timeout)
+
+    def wait_processed_frame(self, last_seq, timeout=1.0):
+        # raw processed frame for consumers that encode on their own (webrtc)
+        self.frame_broadcaster.touch(False)
+        frame_seq, frame = self.jpeg_cache.latest()
+        if frame_seq == last_seq:
+            self.frame_broadcaster.wait_frame(self.frame_broadcaster.frame_seq, timeout, False)
+            frame_seq, frame = self.jpeg_cache.latest()
+        if frame_seq == last_seq:
+            return last_seq, None
+        return frame_seq, frame
+
+    def snapshot(self, max_age=1.0, timeout=2.0):
+        # reuse the streamed jpeg while it is fresh, otherwise wake the pipeline for one frame
+        if time.time() - self.jpeg_cache.frame_time > max_age:
+            self.frame_broadcast_start()
+            self.frame_broadcaster.wait_frame(self.frame_broadcaster.frame_seq, timeout)
+        return self.jpeg_cache.get(self.video_quality, self.scale_rate)
 
     def osd_render(self, osd_frame):
         if not self.add_osd:
             return osd_frame
         
         # add your osd info here
-        # cv2.putText(overlay_buffer, 'OSD_TEST', (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        # overlay_buffer.putText('OSD_TEST', (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
 
         # render lidar data (RPLidar)
         if self.lidar_ctrl:
@@ -358,29 +839,34 @@ class OpencvFuncs():
                     cv2.circle(osd_frame, lidar_point, 2, (0, 0, 255), -1)
 
         # render lidar data (Legacy YDLidar)
-        lidar_points = []
-        for lidar_angle, lidar_distance in zip(self.base_ctrl.rl.lidar_angles_show, self.base_ctrl.rl.lidar_distances_show):
-            lidar_x = int(lidar_distance * np.cos(lidar_angle) * 0.05) + 320
-            lidar_y = int(lidar_distance * np.sin(lidar_angle) * 0.05) + 240
-            lidar_points.append((lidar_x, lidar_y))
+        lidar_angles, lidar_distances = self.base_ctrl.rl.lidar_scan
+        lidar_xs = (lidar_distances * np.cos(lidar_angles) * 0.05).astype(int) + 320
+        lidar_ys = (lidar_distances * np.sin(lidar_angles) * 0.05).astype(int) + 240
 
-        for lidar_point in lidar_points:
+        for lidar_point in zip(lidar_xs.tolist(), lidar_ys.tolist()):
             cv2.circle(osd_frame, lidar_point, 3, (255, 0, 0), -1)
 
         # render sensor data
-        sensor_index = 0
-        for sensor_line in self.base_ctrl.rl.sensor_data:
-            # sensor_line = sensor_line[:-2]
-            cv2.putText(osd_frame, sensor_line,
-                        (100, 50 + sensor_index * 20), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1)
-            sensor_index = sensor_index + 1
+        overlay_ctrl.draw_text_lines(osd_frame, list(self.base_ctrl.rl.sensor_data),
+                        (100, 50), 
+                        0.5, (255,255,255), 1, 20)
 
 
         return osd_frame
 
-    def picture_capture(self):
-        self.picture_capture_flag = True
+    def picture_capture(self, on_captured=None):
+        # on_captured runs on the pipeline thread once the frame is taken,
+        # requests made while a capture is pending share its photo
+        with self.picture_capture_lock:
+            if on_captured is not None:
+                self.picture_captured_callbacks.append(on_captured)
+            self.picture_capture_flag = True
+
+    def picture_burst(self, input_count):
+        if self.burst_remaining > 0:
+            return
+        self.burst_frames = []
+        self.burst_remaining = max(1, min(int(input_count), 100))
 
     def video_record(self, input_cmd):
         if input_cmd:
@@ -401,9 +887,20 @@ class OpencvFuncs():
             self.video_quality = 100
         else:
             self.video_quality = int(input_quality)
+        self.stream_quality.set_max_quality(self.video_quality)
+
+    def detect_every(self, cv_mode):
+        return self.cv_track_every if cv_mode in self.cv_trackers else 1
 
     def set_cv_mode(self, input_mode):
+        # the main mode runs with the highest priority
+        if self.cv_mode != f['code']['cv_none']:
+            self.cv_worker.disable(self.cv_mode)
+            if self.cv_mode in self.cv_trackers:
+                self.cv_trackers[self.cv_mode].clear()
         self.cv_mode = input_mode
+        if self.cv_mode != f['code']['cv_none']:
+            self.cv_worker.enable(self.cv_mode, 0, 0, self.cv_mode in self.cv_gated_modes, self.detect_every(self.cv_mode))
         if self.cv_mode == f['code']['cv_none']:
             self.set_video_record_flag = False
 
@@ -411,13 +908,18 @@ class OpencvFuncs():
         self.detection_reaction_mode = input_reaction
         if self.detection_reaction_mode == f['code']['re_none']:
             self.set_video_record_flag = False
+        if self.detection_reaction_mode == f['code']['re_reco']:
+            self.video_recorder.set_pre_event(self.pre_event_seconds)
+        else:
+            self.video_recorder.set_pre_event(0)
+            self.pre_event_buffer.clear()
 
 
 
-    def cv_detect_movition(self, img):
+    def cv_detect_movition(self, frame_ctx):
         timestamp = datetime.datetime.now()
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)
+        scale = self.cv_input_scale.get(f['code']['cv_moti'], 1)
+        gray = frame_ctx.blurred('gray', int(21 * scale) | 1, scale)
 
         if self.avg is None:
             self.avg = gray.copy().astype("float")
@@ -435,15 +937,15 @@ class OpencvFuncs():
         cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         cnts = imutils.grab_contours(cnts)
         # loop over the contours
-        overlay_buffer = np.zeros_like(img)
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
         for c in cnts:
             # if the contour is too small, ignore it
-            if cv2.contourArea(c) < 2000:
+            if cv2.contourArea(c) < 2000 * scale * scale:
                 continue
             # compute the bounding box for the contour, draw it on the frame,
             # and update the text
-            (mov_x, mov_y, mov_w, mov_h) = cv2.boundingRect(c)
-            cv2.rectangle(overlay_buffer, (mov_x, mov_y), (mov_x + mov_w, mov_y + mov_h), (128, 255, 0), 1)
+            (mov_x, mov_y, mov_w, mov_h) = (int(v / scale) for v in cv2.boundingRect(c))
+            overlay_buffer.rectangle((mov_x, mov_y), (mov_x + mov_w, mov_y + mov_h), (128, 255, 0), 1)
             self.last_movtion_captured = timestamp
 
             if(timestamp - self.last_frame_capture_time).seconds >= 1:
@@ -460,7 +962,61 @@ class OpencvFuncs():
                 if(timestamp - self.last_frame_capture_time).seconds >= 5:
                     self.video_record(False)
 
-        self.overlay = overlay_buffer
+        return overlay_buffer
+
+    def update_tracker(self, cv_mode, frame_ctx, boxes, scores=None, class_ids=None):
+        # feeds a detector frame into the tracker of this mode, None if the mode is not tracked
+        tracker = self.cv_trackers.get(cv_mode)
+        if tracker is None:
+            return None
+        if scores is None:
+            scores = np.ones(len(boxes))
+        if class_ids is None:
+            class_ids = np.zeros(len(boxes), dtype=int)
+        tracker.update(boxes, scores, class_ids, frame_ctx.frame_time, frame_ctx.bgr() if tracker.use_cv_tracker else None)
+        return tracker
+
+    def cv_track(self, cv_mode, frame_ctx):
+        # a frame between two detections, called by the cv worker
+        tracker = self.cv_trackers.get(cv_mode)
+        if tracker is None or not tracker.tracks:
+            return None
+        tracker.predict(frame_ctx.frame_time, frame_ctx.bgr() if tracker.use_cv_tracker else None)
+        if cv_mode == f['code']['cv_face']:
+            self.face_gimbal_track(tracker, frame_ctx)
+        return self.tracked_overlay(cv_mode)
+
+    def tracked_overlay(self, cv_mode, overlay_buffer=None):
+        # the detector's own texts plus the current track boxes and ids
+        tracker = self.cv_trackers.get(cv_mode)
+        if tracker is None:
+            return overlay_buffer
+        if overlay_buffer is not None:
+            self.track_overlays[cv_mode] = overlay_buffer
+        overlay_buffer = self.track_overlays.get(cv_mode, overlay_ctrl.OverlayCanvas()).copy()
+        for track in tracker.confirmed():
+            (startX, startY, endX, endY) = track.box().astype("int")
+            if cv_mode == f['code']['cv_face']:
+                label, color = 'face', (64, 128, 255)
+            elif cv_mode == f['code']['cv_fire']:
+                label = self.fire_detector.class_names[track.class_id]
+                color = (0, 0, 255) if label in self.fire_alarm_classes else (128, 128, 128)
+            else:
+                label, color = self.class_names[track.class_id], (0, 255, 0)
+            overlay_buffer.rectangle((startX, startY), (endX, endY), color, 1)
+            y = startY - 15 if startY - 15 > 15 else startY + 15
+            overlay_buffer.text("{} #{}".format(label, track.track_id), (startX, y), 0.5, color, 1)
+        return overlay_buffer
+
+    def face_gimbal_track(self, tracker, frame_ctx):
+        # follows the smoothed center of the largest face track instead of raw detections.
+        # a kalman prediction does not see the camera turn, only a track measured on
+        # this frame steers the gimbal, otherwise it holds
+        track = tracker.primary()
+        if track is None or self.cv_movtion_lock or track.last_measured != frame_ctx.frame_time:
+            return
+        face_x, face_y = track.center()
+        self.gimbal_track(frame_ctx.width // 2, frame_ctx.height // 2, face_x, face_y, self.track_faces_iterate)
 
     def gimbal_track(self, fx, fy, gx, gy, iterate):
         global gimbal_x, gimbal_y
@@ -488,17 +1044,54 @@ class OpencvFuncs():
             self.base_ctrl.base_json_ctrl({"T":self.CMD_GIMBAL,"X":self.pan_angle,"Y":self.tilt_angle,"SPD":gimbal_spd,"ACC":gimbal_acc})
         return distance
 
-    def cv_detect_faces(self, img):
-        gray_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    def face_search(self, gray_img, scale, min_size, max_size, offset=(0, 0)):
+        # detectMultiScale on a downscaled gray image, faces (x, y, w, h) in full frame pixels
+        min_size = max(1, int(min_size * scale))
+        max_size = max(min_size + 1, int(max_size * scale))
         faces = self.faceCascade.detectMultiScale(
                 gray_img,     
-                scaleFactor=1.2,
+                scaleFactor=self.face_scale_factor,
                 minNeighbors=5,     
-                minSize=(20, 20)
+                minSize=(min_size, min_size),
+                maxSize=(max_size, max_size)
             )
-        overlay_buffer = np.zeros_like(img)
-
-        height, width = img.shape[:2]
+        return [(int((x + offset[0]) / scale), int((y + offset[1]) / scale), int(w / scale), int(h / scale)) for (x, y, w, h) in faces]
+
+    def cv_detect_faces(self, frame_ctx):
+        scale = self.cv_input_scale.get(f['code']['cv_face'], 1)
+        gray_img = frame_ctx.gray(scale)
+
+        # every tracked face is searched for in a window around it, at sizes close to its own,
+        # the whole frame is searched every face_full_every passes and after a miss
+        tracker = self.cv_trackers.get(f['code']['cv_face'])
+        tracks = tracker.tracks if tracker is not None else []
+        self.face_passes += 1
+        faces = []
+        if tracks and self.face_passes % self.face_full_every:
+            for track in tracks:
+                x1, y1, x2, y2 = track.box()
+                size = max(x2 - x1, y2 - y1)
+                wx1, wy1 = int(max(0, x1 - size) * scale), int(max(0, y1 - size) * scale)
+                wx2, wy2 = int(min(frame_ctx.width, x2 + size) * scale), int(min(frame_ctx.height, y2 + size) * scale)
+                window_faces = []
+                if wx2 > wx1 and wy2 > wy1:
+                    window_faces = self.face_search(gray_img[wy1:wy2, wx1:wx2], scale,
+                                                    max(self.face_min_size, size * 0.6), min(self.face_max_size, size * 1.6), (wx1, wy1))
+                if not window_faces:
+                    # lost or gone, the full search below finds it again
+                    self.face_passes = 0
+                    break
+                faces.extend(window_faces)
+            if len(tracks) > 1 and faces:
+                # windows of faces close together overlap, one box per face
+                boxes = np.array([(x, y, x + w, y + h) for (x, y, w, h) in faces], dtype=np.float32)
+                faces = [faces[i] for i in fire_ctrl.nms(boxes, boxes[:, 2] - boxes[:, 0], 0.3, 0.8)]
+        if not tracks or not self.face_passes % self.face_full_every:
+            faces = self.face_search(gray_img, scale, self.face_min_size, self.face_max_size)
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
+        tracker = self.update_tracker(f['code']['cv_face'], frame_ctx, [(x, y, x + w, y + h) for (x, y, w, h) in faces])
+
+        height, width = frame_ctx.height, frame_ctx.width
         center_x, center_y = width // 2, height // 2
 
         max_area = 0
@@ -511,13 +1104,14 @@ class OpencvFuncs():
                     self.base_ctrl.lights_ctrl(self.base_ctrl.base_light_status, self.base_ctrl.head_light_status)
 
             for (x,y,w,h) in faces:
-                cv2.rectangle(overlay_buffer,(x,y),(x+w,y+h),(64,128,255),1)
+                if tracker is None:
+                    overlay_buffer.rectangle((x,y),(x+w,y+h),(64,128,255),1)
                 face_area = w * h
                 if face_area > max_area:
                     max_area = face_area
                     max_face_center = (x + w // 2, y + h // 2)
 
-            if not self.cv_movtion_lock:
+            if not self.cv_movtion_lock and tracker is None:
                 self.gimbal_track(center_x, center_y, max_face_center[0], max_face_center[1], self.track_faces_iterate)
 
             if(datetime.datetime.now() - self.last_frame_capture_time).seconds >= 3:
@@ -538,46 +1132,97 @@ class OpencvFuncs():
                 if(datetime.datetime.now() - self.last_frame_capture_time).seconds >= 5:
                     self.video_record(False)
 
-        cv2.putText(overlay_buffer, 'NUMBER: {}'.format(len(faces)), (center_x+50, center_y+40), 
-                                                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, 'ITERATE: {}'.format(self.track_faces_iterate), (center_x+50, center_y+60), 
-                                                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' SPD_R: {}'.format(self.track_spd_rate), (center_x+50, center_y+80), 
-                                                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' ACC_R: {}'.format(self.track_acc_rate), (center_x+50, center_y+100), 
-                                                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        self.overlay = overlay_buffer
-
-    def cv_detect_objects(self, img):
-        overlay_buffer = np.zeros_like(img)
-        cv2.putText(overlay_buffer, 'CV_OBJS', (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-
-        (h, w) = img.shape[:2]
-        blob = cv2.dnn.blobFromImage(cv2.resize(img, (300, 300)), 0.007843, (300, 300), 127.5)
+        face_count = len(tracker.confirmed()) if tracker is not None else len(faces)
+        overlay_buffer.text('NUMBER: {}'.format(face_count), (center_x+50, center_y+40), 
+                                                            0.5, (255, 255, 255), 1)
+        overlay_buffer.text('ITERATE: {}'.format(self.track_faces_iterate), (center_x+50, center_y+60), 
+                                                         0.5, (255, 255, 255), 1)
+        overlay_buffer.text(' SPD_R: {}'.format(self.track_spd_rate), (center_x+50, center_y+80), 
+                                                        0.5, (255, 255, 255), 1)
+        overlay_buffer.text(' ACC_R: {}'.format(self.track_acc_rate), (center_x+50, center_y+100), 
+                                                        0.5, (255, 255, 255), 1)
+        if tracker is not None:
+            self.face_gimbal_track(tracker, frame_ctx)
+        return self.tracked_overlay(f['code']['cv_face'], overlay_buffer)
+
+    def cv_detect_objects(self, frame_ctx):
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
+        overlay_buffer.text('CV_OBJS', (50, 50), 1, (255, 255, 255), 2)
+
+        # resized first, the channel swap then runs on 300x300 only
+        (h, w) = frame_ctx.height, frame_ctx.width
+        blob = cv2.dnn.blobFromImage(cv2.resize(frame_ctx.bgr(), (300, 300)), 0.007843, (300, 300), 127.5, swapRB=True)
         self.net.setInput(blob)
         detections = self.net.forward()
 
-        for i in range(0, detections.shape[2]):
-            confidence = detections[0, 0, i, 2]
+        # confidence > 0.2, boxes in frame pixels
+        detections = detections[0, 0][detections[0, 0, :, 2] > 0.2]
+        boxes = detections[:, 3:7] * np.array([w, h, w, h])
+        tracker = self.update_tracker(f['code']['cv_objs'], frame_ctx, boxes, detections[:, 2], detections[:, 1].astype(int))
+        if tracker is not None:
+            return self.tracked_overlay(f['code']['cv_objs'], overlay_buffer)
+
+        for box, confidence, idx in zip(boxes, detections[:, 2], detections[:, 1].astype(int)):
+            (startX, startY, endX, endY) = box.astype("int")
+
+            label = "{}: {:.2f}%".format(self.class_names[idx], confidence * 100)
+            overlay_buffer.rectangle((startX, startY), (endX, endY), (0, 255, 0), 2)
+            y = startY - 15 if startY - 15 > 15 else startY + 15
+            overlay_buffer.putText(label, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+
+        return overlay_buffer
+
+    def cv_detect_fire(self, frame_ctx):
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
+        overlay_buffer.text('CV_FIRE', (50, 50), 1, (255, 255, 255), 2)
+        if not self.fire_detector.load():
+            overlay_buffer.text('fire model not found', (50, 80), 0.5, (0, 0, 255), 1)
+            return overlay_buffer
+
+        if self.fire_tiles:
+            # tiles with fire colored pixels or motion are searched first
+            regions = fire_ctrl.color_regions(frame_ctx.hsv(0.25), 0.25)
+            if frame_ctx.change_regions:
+                regions += frame_ctx.change_regions
+            boxes, scores, class_ids = self.fire_detector.detect_tiled(frame_ctx.bgr(), regions,
+                                                                       self.fire_tile_budget, self.fire_tile_overlap)
+            overlay_buffer.putText('TILES: {}'.format(self.fire_detector.tile_count), (50, 80), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        else:
+            boxes, scores, class_ids = self.fire_detector.detect(frame_ctx.bgr())
 
-            if confidence > 0.2:
-                idx = int(detections[0, 0, i, 1])
-                box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-                (startX, startY, endX, endY) = box.astype("int")
+        tracker = self.update_tracker(f['code']['cv_fire'], frame_ctx, boxes, scores, class_ids)
 
-                label = "{}: {:.2f}%".format(self.class_names[idx], confidence * 100)
-                cv2.rectangle(overlay_buffer, (startX, startY), (endX, endY), (0, 255, 0), 2)
+        fire_detected = False
+        for box, score, class_id in zip(boxes, scores, class_ids):
+            class_name = self.fire_detector.class_names[class_id]
+            if tracker is None:
+                (startX, startY, endX, endY) = box.astype("int")
+                color = (0, 0, 255) if class_name in self.fire_alarm_classes else (128, 128, 128)
+                overlay_buffer.rectangle((startX, startY), (endX, endY), color, 2)
                 y = startY - 15 if startY - 15 > 15 else startY + 15
-                cv2.putText(overlay_buffer, label, (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+                overlay_buffer.putText("{}: {:.2f}%".format(class_name, score * 100), (startX, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+            if class_name in self.fire_alarm_classes:
+                fire_detected = True
 
-        self.overlay = overlay_buffer
+        if fire_detected:
+            if(datetime.datetime.now() - self.last_frame_capture_time).seconds >= 3:
+                if self.detection_reaction_mode == f['code']['re_none']:
+                    pass
+                elif self.detection_reaction_mode == f['code']['re_capt']:
+                    self.picture_capture()
+                elif self.detection_reaction_mode == f['code']['re_reco']:
+                    self.video_record(True)
+                self.last_frame_capture_time = datetime.datetime.now()
+        else:
+            if self.detection_reaction_mode == f['code']['re_reco']:
+                if(datetime.datetime.now() - self.last_frame_capture_time).seconds >= 5:
+                    self.video_record(False)
 
-    def cv_detect_color(self, img):
+        return self.tracked_overlay(f['code']['cv_fire'], overlay_buffer)
+
+    def cv_detect_color(self, frame_ctx):
         global head_light_pwm
-        blurred = cv2.GaussianBlur(img, (11, 11), 0)
-        hsv = cv2.cvtColor(blurred, cv2.COLOR_BGR2HSV)
+        hsv = frame_ctx.hsv(1, 11)
 
         mask = cv2.inRange(hsv, self.color_lower, self.color_upper)
         mask = cv2.erode(mask, None, iterations=5)
@@ -588,9 +1233,9 @@ class OpencvFuncs():
         cnts = imutils.grab_contours(cnts)
         center = None
 
-        overlay_buffer = np.zeros_like(img)
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
 
-        height, width = img.shape[:2]
+        height, width = frame_ctx.height, frame_ctx.width
         center_x, center_y = width // 2, height // 2
 
         mask = np.zeros((height, width), dtype=np.uint8)
@@ -601,16 +1246,16 @@ class OpencvFuncs():
         lower_hsv = np.min(masked_hsv_pixels, axis=0)
         upper_hsv = np.max(masked_hsv_pixels, axis=0)
 
-        cv2.putText(overlay_buffer, ' UPPER: {}'.format(upper_hsv), (center_x+50, center_y+40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' LOWER: {}'.format(lower_hsv), (center_x+50, center_y+60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        overlay_buffer.putText(' UPPER: {}'.format(upper_hsv), (center_x+50, center_y+40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        overlay_buffer.putText(' LOWER: {}'.format(lower_hsv), (center_x+50, center_y+60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
-        cv2.putText(overlay_buffer, ' UPPER: {}'.format(self.color_upper), (center_x+50, center_y+100), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
-        cv2.putText(overlay_buffer, ' LOWER: {}'.format(self.color_lower), (center_x+50, center_y+120), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
-        cv2.putText(overlay_buffer, 'ITERATE: {}'.format(self.track_color_iterate), (center_x+50, center_y+140), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' SPD_R: {}'.format(self.track_spd_rate), (center_x+50, center_y+160), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' ACC_R: {}'.format(self.track_acc_rate), (center_x+50, center_y+180), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        overlay_buffer.text(' UPPER: {}'.format(self.color_upper), (center_x+50, center_y+100), 0.5, (255, 128, 128), 1)
+        overlay_buffer.text(' LOWER: {}'.format(self.color_lower), (center_x+50, center_y+120), 0.5, (255, 128, 128), 1)
+        overlay_buffer.text('ITERATE: {}'.format(self.track_color_iterate), (center_x+50, center_y+140), 0.5, (255, 255, 255), 1)
+        overlay_buffer.text(' SPD_R: {}'.format(self.track_spd_rate), (center_x+50, center_y+160), 0.5, (255, 255, 255), 1)
+        overlay_buffer.text(' ACC_R: {}'.format(self.track_acc_rate), (center_x+50, center_y+180), 0.5, (255, 255, 255), 1)
         
-        cv2.circle(overlay_buffer, (center_x, center_y), self.sampling_rad, (64, 255, 64), 1)
+        overlay_buffer.circle((center_x, center_y), self.sampling_rad, (64, 255, 64), 1)
 
         # only proceed if at least one contour was found
         if len(cnts) > 0:
@@ -632,16 +1277,16 @@ class OpencvFuncs():
                     else:
                         head_light_pwm = 0
                         self.base_ctrl.lights_ctrl(self.base_ctrl.base_light_status, head_light_pwm)
-                    cv2.putText(overlay_buffer, 'DIF: {}'.format(distance), (center_x+50, center_y+20), 
+                    overlay_buffer.putText('DIF: {}'.format(distance), (center_x+50, center_y+20), 
                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
                 # draw the circle and centroid on the frame,
                 # then update the list of tracked points
-                cv2.circle(overlay_buffer, (int(x), int(y)), int(radius),
+                overlay_buffer.circle((int(x), int(y)), int(radius),
                     (128, 255, 255), 1)
-                cv2.circle(overlay_buffer, center, 3, (128, 255, 255), -1)
-                cv2.line(overlay_buffer, center, (center_x, center_y), (0, 0, 255), 1)
-                cv2.putText(overlay_buffer, 'RAD: {}'.format(radius), (center_x+50, center_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+                overlay_buffer.circle(center, 3, (128, 255, 255), -1)
+                overlay_buffer.line(center, (center_x, center_y), (0, 0, 255), 1)
+                overlay_buffer.putText('RAD: {}'.format(radius), (center_x+50, center_y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
                 self.points.appendleft(center)
             else:
@@ -652,10 +1297,9 @@ class OpencvFuncs():
             for i in range(1, len(self.points)):
                 if self.points[i-1] is None or self.points[i] is None:
                     continue
-                cv2.line(overlay_buffer, self.points[i - 1], self.points[i], (255, 255, 128), 1)
+                overlay_buffer.line(self.points[i - 1], self.points[i], (255, 255, 128), 1)
 
-        self.overlay = np.zeros_like(img)
-        self.overlay = overlay_buffer
+        return overlay_buffer
 
     def calculate_distance(self, lm1, lm2):
         return ((lm1.x - lm2.x) ** 2 + (lm1.y - lm2.y) ** 2) ** 0.5
@@ -680,26 +1324,26 @@ class OpencvFuncs():
             return 0
         return (value - original_min) / (original_max - original_min) * (new_max - new_min) + new_min
 
-    def mp_detect_hand(self, img):
-        height, width = img.shape[:2]
+    def mp_detect_hand(self, frame_ctx):
+        height, width = frame_ctx.height, frame_ctx.width
         center_x, center_y = width // 2, height // 2
 
-        imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        imgRGB = frame_ctx.rgb(self.cv_input_scale.get(f['code']['mp_hand'], 1))
         results = self.hands.process(imgRGB)
 
-        overlay_buffer = np.zeros_like(imgRGB)
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
         get_pwm = 0
 
         if results.multi_hand_landmarks:
             for handLms in results.multi_hand_landmarks:
                 # draw joints
                 for id, lm in enumerate(handLms.landmark):
-                    h, w, c = imgRGB.shape
+                    h, w = height, width
                     cx, cy = int(lm.x * w), int(lm.y * h)
-                    cv2.circle(overlay_buffer, (cx, cy), 5, (255, 0, 0), -1)
+                    overlay_buffer.circle((cx, cy), 5, (255, 0, 0), -1)
 
                 # draw lines
-                self.mpDraw.draw_landmarks(overlay_buffer, handLms, self.mpHands.HAND_CONNECTIONS)
+                overlay_buffer.draw(self.mpDraw.draw_landmarks, handLms, self.mpHands.HAND_CONNECTIONS)
 
                 target_pos = handLms.landmark[self.mpHands.HandLandmark.INDEX_FINGER_TIP]
                 # print(f"x:{target_pos.x} y:{target_pos.y}")
@@ -727,7 +1371,7 @@ class OpencvFuncs():
 
                 # LED Ctrl
                 if middle_finger_gs > 20 and pinky_finger_gs > 90:
-                    cv2.putText(overlay_buffer, ' GS: LED Ctrl', (center_x+50, center_y+100), 
+                    overlay_buffer.putText(' GS: LED Ctrl', (center_x+50, center_y+100), 
                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
                     tips_distance = self.calculate_distance(handLms.landmark[self.mpHands.HandLandmark.INDEX_FINGER_TIP],
                         handLms.landmark[self.mpHands.HandLandmark.THUMB_TIP])
@@ -746,35 +1390,33 @@ class OpencvFuncs():
 
                 # Take Pic
                 elif middle_finger_gs < 10 and pinky_finger_gs > 90 and index_finger_gs < 10:
-                    cv2.putText(overlay_buffer, ' GS: Take Pic', (center_x+50, center_y+100), 
+                    overlay_buffer.putText(' GS: Take Pic', (center_x+50, center_y+100), 
                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
                     if time.time() - self.gs_pic_last_time > self.gs_pic_interval:
                         self.base_ctrl.lights_ctrl(255, 255)
-                        time.sleep(0.01)
-                        self.picture_capture()
-                        self.base_ctrl.lights_ctrl(0, 0)
+                        self.picture_capture(lambda: self.base_ctrl.lights_ctrl(0, 0))
                         self.gs_pic_last_time = time.time()
 
                 # Not Found
                 else:
-                    cv2.putText(overlay_buffer, ' GS: Not Defined', (center_x+50, center_y+100), 
+                    overlay_buffer.putText(' GS: Not Defined', (center_x+50, center_y+100), 
                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
                     self.base_ctrl.lights_ctrl(0, 0)
 
-        cv2.putText(overlay_buffer, 'ITERATE: {}'.format(self.track_faces_iterate), (center_x+50, center_y+140), 
-            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' SPD_R: {}'.format(self.track_spd_rate), (center_x+50, center_y+160), 
-            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' ACC_R: {}'.format(self.track_acc_rate), (center_x+50, center_y+180), 
-            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        overlay_buffer.text('ITERATE: {}'.format(self.track_faces_iterate), (center_x+50, center_y+140), 
+            0.5, (255, 255, 255), 1)
+        overlay_buffer.text(' SPD_R: {}'.format(self.track_spd_rate), (center_x+50, center_y+160), 
+            0.5, (255, 255, 255), 1)
+        overlay_buffer.text(' ACC_R: {}'.format(self.track_acc_rate), (center_x+50, center_y+180), 
+            0.5, (255, 255, 255), 1)
 
-        self.overlay = overlay_buffer
+        return overlay_buffer
 
-    def cv_auto_drive(self, img):
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    def cv_auto_drive(self, frame_ctx):
+        hsv = frame_ctx.hsv()
 
         # get a sampling
-        height, width = img.shape[:2]
+        height, width = frame_ctx.height, frame_ctx.width
         center_x, center_y = width // 2, height // 2
         mask_sampling = np.zeros((height, width), dtype=np.uint8)
         cv2.circle(mask_sampling, (center_x, center_y), int(self.sampling_rad/4), (255), thickness=-1)
@@ -848,60 +1490,60 @@ class OpencvFuncs():
         if not self.cv_movtion_lock:
             self.base_ctrl.base_json_ctrl({"T":13,"X":input_speed,"Z":input_turning})
 
-        overlay_buffer = np.zeros_like(img)
-        overlay_buffer = cv2.cvtColor(line_mask, cv2.COLOR_GRAY2BGR)
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
+        overlay_buffer.fill_mask(line_mask, (255, 255, 255))
 
-        cv2.putText(overlay_buffer, 'Line Following', (100, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
-        cv2.circle(overlay_buffer, (center_x, center_y), int(self.sampling_rad/4), (64, 255, 64), 1)
+        overlay_buffer.text('Line Following', (100, 70), 0.6, (255, 255, 255), 1)
+        overlay_buffer.circle((center_x, center_y), int(self.sampling_rad/4), (64, 255, 64), 1)
 
-        cv2.putText(overlay_buffer, ' SAM_H1: {}'.format(self.sampling_line_1), (center_x-150, sampling_h1-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
-        cv2.putText(overlay_buffer, ' SAM_H2: {}'.format(self.sampling_line_2), (center_x-150, sampling_h2-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
+        overlay_buffer.text(' SAM_H1: {}'.format(self.sampling_line_1), (center_x-150, sampling_h1-10), 0.5, (255, 128, 128), 1)
+        overlay_buffer.text(' SAM_H2: {}'.format(self.sampling_line_2), (center_x-150, sampling_h2-10), 0.5, (255, 128, 128), 1)
 
-        cv2.putText(overlay_buffer, f'X: {input_speed:.2f}, Z: {input_turning:.2f}', (center_x+50, center_y+0), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        overlay_buffer.putText(f'X: {input_speed:.2f}, Z: {input_turning:.2f}', (center_x+50, center_y+0), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
-        cv2.putText(overlay_buffer, ' UPPER: {}'.format(upper_hsv), (center_x+50, center_y+40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
-        cv2.putText(overlay_buffer, ' LOWER: {}'.format(lower_hsv), (center_x+50, center_y+60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        overlay_buffer.putText(' UPPER: {}'.format(upper_hsv), (center_x+50, center_y+40), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        overlay_buffer.putText(' LOWER: {}'.format(lower_hsv), (center_x+50, center_y+60), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
 
-        cv2.putText(overlay_buffer, ' UPPER: {}'.format(self.line_upper), (center_x+50, center_y+100), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
-        cv2.putText(overlay_buffer, ' LOWER: {}'.format(self.line_lower), (center_x+50, center_y+120), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
-        cv2.putText(overlay_buffer, f' SLOPE: {line_slope:.2f}', (center_x+50, center_y+140), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
-        cv2.putText(overlay_buffer, f' SAM_1 SAM_2 SLOPE_IM BASE_IM SPD_IM LT_SPD SLOPE_SPD', (center_x-250, center_y-70), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
-        cv2.putText(overlay_buffer, f' {self.sampling_line_1:.2f}   {self.sampling_line_2:.2f}   {self.slope_impact:.2f}      {self.base_impact:.4f}  {self.speed_impact:.2f}    {self.line_track_speed:.2f}    {self.slope_on_speed:.2f}', (center_x-250, center_y-50), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
+        overlay_buffer.text(' UPPER: {}'.format(self.line_upper), (center_x+50, center_y+100), 0.5, (255, 128, 128), 1)
+        overlay_buffer.text(' LOWER: {}'.format(self.line_lower), (center_x+50, center_y+120), 0.5, (255, 128, 128), 1)
+        overlay_buffer.putText(f' SLOPE: {line_slope:.2f}', (center_x+50, center_y+140), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 128, 128), 1)
+        overlay_buffer.text(f' SAM_1 SAM_2 SLOPE_IM BASE_IM SPD_IM LT_SPD SLOPE_SPD', (center_x-250, center_y-70), 0.5, (255, 128, 128), 1)
+        overlay_buffer.text(f' {self.sampling_line_1:.2f}   {self.sampling_line_2:.2f}   {self.slope_impact:.2f}      {self.base_impact:.4f}  {self.speed_impact:.2f}    {self.line_track_speed:.2f}    {self.slope_on_speed:.2f}', (center_x-250, center_y-50), 0.5, (255, 128, 128), 1)
 
-        cv2.line(overlay_buffer, (0, sampling_h1), (width, sampling_h1), (255, 0, 0), 2)
-        cv2.line(overlay_buffer, (0, sampling_h2), (width, sampling_h2), (255, 0, 0), 2)
+        overlay_buffer.line((0, sampling_h1), (width, sampling_h1), (255, 0, 0), 2)
+        overlay_buffer.line((0, sampling_h2), (width, sampling_h2), (255, 0, 0), 2)
 
         if sam_1:
-            cv2.line(overlay_buffer, (sampling_1_left, sampling_h1+20), (sampling_1_left, sampling_h1-20), (0, 255, 0), 2)
-            cv2.line(overlay_buffer, (sampling_1_right, sampling_h1+20), (sampling_1_right, sampling_h1-20), (0, 255, 0), 2)
+            overlay_buffer.line((sampling_1_left, sampling_h1+20), (sampling_1_left, sampling_h1-20), (0, 255, 0), 2)
+            overlay_buffer.line((sampling_1_right, sampling_h1+20), (sampling_1_right, sampling_h1-20), (0, 255, 0), 2)
         if sam_2:
-            cv2.line(overlay_buffer, (sampling_2_left, sampling_h2+20), (sampling_2_left, sampling_h2-20), (0, 255, 0), 2)
-            cv2.line(overlay_buffer, (sampling_2_right, sampling_h2+20), (sampling_2_right, sampling_h2-20), (0, 255, 0), 2)
+            overlay_buffer.line((sampling_2_left, sampling_h2+20), (sampling_2_left, sampling_h2-20), (0, 255, 0), 2)
+            overlay_buffer.line((sampling_2_right, sampling_h2+20), (sampling_2_right, sampling_h2-20), (0, 255, 0), 2)
         if sam_1 and sam_2:
-            cv2.line(overlay_buffer, (sampling_1_center, sampling_h1), (sampling_2_center, sampling_h2), (255, 0, 0), 2)
+            overlay_buffer.line((sampling_1_center, sampling_h1), (sampling_2_center, sampling_h2), (255, 0, 0), 2)
 
-        self.overlay = overlay_buffer
+        return overlay_buffer
 
-    def mediaPipe_faces(self, img):
-        image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def mediaPipe_faces(self, frame_ctx):
+        image = frame_ctx.rgb(self.cv_input_scale.get(f['code']['mp_face'], 1))
         results = self.face_detection.process(image)
 
-        overlay_buffer = np.zeros_like(image)
-        cv2.putText(overlay_buffer, 'MediaPipe Faces', (100, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
+        overlay_buffer.text('MediaPipe Faces', (100, 70), 0.6, (255, 255, 255), 1)
         if results.detections:
             for detection in results.detections:
-                self.mpDraw.draw_detection(overlay_buffer, detection)
-        self.overlay = overlay_buffer
+                overlay_buffer.draw(self.mpDraw.draw_detection, detection)
+        return overlay_buffer
 
-    def mediaPipe_pose(self, img):
-        image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def mediaPipe_pose(self, frame_ctx):
+        image = frame_ctx.rgb(self.cv_input_scale.get(f['code']['mp_pose'], 1))
         results = self.pose.process(image)
 
-        overlay_buffer = np.zeros_like(image)
-        cv2.putText(overlay_buffer, 'MediaPipe Pose', (100, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+        overlay_buffer = overlay_ctrl.OverlayCanvas()
+        overlay_buffer.text('MediaPipe Pose', (100, 70), 0.6, (255, 255, 255), 1)
         if results.pose_landmarks:
-            self.mpDraw.draw_landmarks(overlay_buffer, results.pose_landmarks, self.mp_pose.POSE_CONNECTIONS)
-        self.overlay = overlay_buffer
+            overlay_buffer.draw(self.mpDraw.draw_landmarks, results.pose_landmarks, self.mp_pose.POSE_CONNECTIONS)
+        return overlay_buffer
 
 
 
@@ -920,10 +1562,16 @@ class OpencvFuncs():
         return
 
     def show_recv_info(self, input_cmd):
+        # every feedback type while shown, which asks the base for faster feedback
         if input_cmd == True:
             self.show_base_info_flag = True
+            if self.recv_subscription is None:
+                self.recv_subscription = self.base_ctrl.feedback.subscribe(lambda slot: self.update_base_data(slot.data), interval=100)
         else:
             self.show_base_info_flag = False
+            if self.recv_subscription is not None:
+                self.base_ctrl.feedback.unsubscribe(self.recv_subscription)
+                self.recv_subscription = None
         print(self.show_base_info_flag)
 
     def format_json_numbers(self, obj):
@@ -941,20 +1589,46 @@ class OpencvFuncs():
         try:
             if self.show_base_info_flag:
                 self.recv_deque.appendleft(json.dumps(self.format_json_numbers(input_data)))
-            if input_data['T'] == 1003:
-                self.info_deque.appendleft({'text':json.dumps(input_data['mac']),'color':(16,64,255),'size':0.5})
-                wrapped_lines = textwrap.wrap(json.dumps(input_data['megs']), self.recv_line_max)
-                for line in wrapped_lines:
-                    self.info_deque.appendleft({'text':line,'color':(255,255,255),'size':0.5})
-                self.info_update_time = time.time()
-                self.show_info_flag = True
         except Exception as e:
             print(f"[cv_ctrl.update_base_data] error: {e}")
 
+    def update_espnow_megs(self, input_data):
+        # T:1003, a message received over esp-now
+        print(input_data)
+        try:
+            self.info_deque.appendleft({'text':json.dumps(input_data['mac']),'color':(16,64,255),'size':0.5})
+            wrapped_lines = textwrap.wrap(json.dumps(input_data['megs']), self.recv_line_max)
+            for line in wrapped_lines:
+                self.info_deque.appendleft({'text':line,'color':(255,255,255),'size':0.5})
+            self.info_update_time = time.time()
+            self.show_info_flag = True
+        except Exception as e:
+            print(f"[cv_ctrl.update_espnow_megs] error: {e}")
+
 
 
 
-    def cv_process(self, frame):
+    def cv_result_received(self, result):
+        latency = time.time() - result.frame_time
+        self.cv_latency[result.mode] = 0.9 * self.cv_latency.get(result.mode, latency) + 0.1 * latency
+
+    def cv_stats(self):
+        # worker timing plus the result latency in ms
+        stats = self.cv_worker.stats()
+        for mode, latency in self.cv_latency.items():
+            stats.setdefault(mode, {})['latency'] = round(latency * 1000, 1)
+        return stats
+
+    def set_cv_detector(self, input_mode, input_rate, input_priority=1):
+        # extra detectors next to the main mode, a rate below 0 disables it
+        if input_mode == f['code']['cv_none'] or input_mode == self.cv_mode:
+            return
+        if input_rate < 0:
+            self.cv_worker.disable(input_mode)
+        else:
+            self.cv_worker.enable(input_mode, input_rate, input_priority, input_mode in self.cv_gated_modes, self.detect_every(input_mode))
+
+    def cv_process(self, cv_mode, frame_ctx):
         cv_mode_list = {
             f['code']['cv_moti']: self.cv_detect_movition,
             f['code']['cv_face']: self.cv_detect_faces,
@@ -963,17 +1637,13 @@ class OpencvFuncs():
             f['code']['mp_hand']: self.mp_detect_hand,
             f['code']['cv_auto']: self.cv_auto_drive,
             f['code']['mp_face']: self.mediaPipe_faces,
-            f['code']['mp_pose']: self.mediaPipe_pose
+            f['code']['mp_pose']: self.mediaPipe_pose,
+            f['code']['cv_fire']: self.cv_detect_fire
         }
         try:
-            cv_mode_list[self.cv_mode](frame)
+            return cv_mode_list[cv_mode](frame_ctx)
         except Exception as e:
             print(f'[cv_ctrl.cv_process] error: {e}')
-        self.cv_event.clear()
-
-    def opencv_threading(self, input_img):
-        cv_thread = threading.Thread(target=self.cv_process, args=(input_img,), daemon=True)
-        cv_thread.start()
 
     def head_light_ctrl(self, input_mode):
         self.cv_light_mode = input_mode
@@ -1049,9 +1719,7 @@ class OpencvFuncs():
             self.base_ctrl.base_json_ctrl({"T":1,"L":0,"R":0})
             time.sleep(input_interval/2)
             self.base_ctrl.lights_ctrl(255, 255)
-            time.sleep(0.01)
-            self.picture_capture()
-            self.base_ctrl.lights_ctrl(0, 0)
+            self.picture_capture(lambda: self.base_ctrl.lights_ctrl(0, 0))
             time.sleep(input_interval/2)
             if not self.mission_flag:
                 self.mission_flag = False
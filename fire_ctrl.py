@@ -0,0 +1,184 @@
+import cv2
+import time
+import numpy as np
+
+# optional, faster than cv2.dnn on arm cpus when installed
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+def letterbox(frame, size, color=(114, 114, 114)):
+    # resizes keeping the aspect ratio and pads to size x size,
+    # returns the padded image, the ratio and the (x, y) padding
+    height, width = frame.shape[:2]
+    ratio = min(size / width, size / height)
+    new_w, new_h = round(width * ratio), round(height * ratio)
+    pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+    padded = np.full((size, size, 3), color, dtype=np.uint8)
+    padded[pad_y:pad_y+new_h, pad_x:pad_x+new_w] = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    return padded, ratio, (pad_x, pad_y)
+
+
+def nms(boxes, scores, iou_threshold, ios_threshold=None):
+    # boxes as x1, y1, x2, y2, returns the kept indices by descending score.
+    # ios_threshold also drops boxes mostly inside a better one, i.e. a flame
+    # cut at a tile border next to the same flame seen whole
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        h = np.maximum(0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        suppressed = iou > iou_threshold
+        if ios_threshold is not None:
+            suppressed |= inter / (np.minimum(areas[i], areas[rest]) + 1e-9) > ios_threshold
+        order = rest[~suppressed]
+    return np.array(keep, dtype=np.int64)
+
+
+def batched_nms(boxes, scores, class_ids, iou_threshold, ios_threshold=None):
+    # one nms pass for all classes, boxes of different classes are shifted apart
+    # by more than the whole coordinate range, negative coordinates included
+    offsets = class_ids.astype(np.float32)[:, None] * (boxes.max() - boxes.min() + 1)
+    return nms(boxes + offsets, scores, iou_threshold, ios_threshold)
+
+
+def tile_grid(width, height, tile_size, overlap=0.2):
+    # overlapping (x, y, w, h) tiles of tile_size covering the frame at full resolution
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        count = int(np.ceil((length - tile_size) / (tile_size * (1 - overlap)))) + 1
+        return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+    return [(x, y, min(tile_size, width), min(tile_size, height)) for y in starts(height) for x in starts(width)]
+
+
+def color_regions(hsv, scale, min_area=4):
+    # bright orange and yellow blobs in a downscaled hsv image, (x, y, w, h) at full resolution
+    mask = cv2.inRange(hsv, (0, 80, 180), (35, 255, 255))
+    cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    return [tuple(int(v / scale) for v in cv2.boundingRect(c)) for c in cnts if cv2.contourArea(c) >= min_area]
+
+
+def overlaps(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+class FireDetector():
+    """YOLOv8 fire and smoke model exported to ONNX, run with onnxruntime
+    when available and cv2.dnn otherwise, no torch or ultralytics needed.
+    Export the trained weights once with:
+    yolo export model=best.pt format=onnx imgsz=320 opset=12"""
+    def __init__(self, model_path, class_names, input_size=320, conf_threshold=0.35, iou_threshold=0.45):
+        self.model_path = model_path
+        self.class_names = class_names
+        self.input_size = input_size
+        self.conf_threshold = conf_threshold
+        self.iou_threshold = iou_threshold
+        self.session = None
+        self.net = None
+        self.loaded = False
+        self.load_failed = False
+
+        # tiled inference, run times are averaged to fit the tile count into the budget
+        self.full_time = 0
+        self.tile_time = 0
+        self.tile_cursor = 0
+        self.tile_count = 0
+
+    def load(self):
+        # tried once, a missing model is not looked up again on every frame
+        if self.loaded or self.load_failed:
+            return self.loaded
+        try:
+            if onnxruntime is not None:
+                self.session = onnxruntime.InferenceSession(self.model_path, providers=['CPUExecutionProvider'])
+                self.input_name = self.session.get_inputs()[0].name
+            else:
+                self.net = cv2.dnn.readNetFromONNX(self.model_path)
+            self.loaded = True
+        except Exception as e:
+            print(f"[fire_ctrl.FireDetector.load] error: {e}")
+            self.load_failed = True
+        return self.loaded
+
+    def infer(self, blob):
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: blob})[0]
+        self.net.setInput(blob)
+        return self.net.forward()
+
+    def detect(self, frame, offset=(0, 0), apply_nms=True):
+        # returns boxes (x1, y1, x2, y2 in frame coordinates plus offset), scores and class ids
+        padded, ratio, (pad_x, pad_y) = letterbox(frame, self.input_size)
+        blob = cv2.dnn.blobFromImage(padded, 1 / 255.0, swapRB=True)
+        output = self.infer(blob)
+
+        # (1, 4 + classes, anchors) -> (anchors, 4 + classes)
+        predictions = output[0].T
+        class_scores = predictions[:, 4:]
+        class_ids = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(class_ids)), class_ids]
+        mask = scores > self.conf_threshold
+        if not mask.any():
+            return np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int64)
+        predictions, scores, class_ids = predictions[mask], scores[mask], class_ids[mask]
+
+        # center, size in the padded input -> corners in the frame
+        cx, cy, w, h = predictions[:, 0], predictions[:, 1], predictions[:, 2], predictions[:, 3]
+        boxes = np.stack([cx - w / 2 - pad_x, cy - h / 2 - pad_y, cx + w / 2 - pad_x, cy + h / 2 - pad_y], axis=1) / ratio
+        # boxes reaching into the padding are cut at the frame (or tile) border
+        height, width = frame.shape[:2]
+        np.clip(boxes, 0, [width, height, width, height], out=boxes)
+        boxes += np.array([offset[0], offset[1], offset[0], offset[1]], dtype=np.float32)
+
+        if not apply_nms:
+            return boxes, scores, class_ids
+        keep = batched_nms(boxes, scores, class_ids, self.iou_threshold)
+        return boxes[keep], scores[keep], class_ids[keep]
+
+    def detect_tiled(self, frame, regions=(), budget=0.25, overlap=0.2):
+        """One downscaled pass over the whole frame for large fires, then
+        full resolution tiles for small ones. Tiles touching a proposed
+        region (color or motion) go first, the others take turns over the
+        following frames. As many tiles run as the time budget allows."""
+        height, width = frame.shape[:2]
+        tiles = tile_grid(width, height, self.input_size, overlap)
+
+        start_time = time.time()
+        results = [self.detect(frame, apply_nms=False)]
+        self.full_time = 0.8 * self.full_time + 0.2 * (time.time() - start_time) if self.full_time else time.time() - start_time
+
+        if len(tiles) > 1:
+            hot = [i for i, tile in enumerate(tiles) if any(overlaps(tile, region) for region in regions)]
+            cold = [i for i in range(len(tiles)) if i not in hot]
+            cold = cold[self.tile_cursor % len(cold):] + cold[:self.tile_cursor % len(cold)] if cold else []
+            if self.tile_time:
+                self.tile_count = max(0, int((budget - self.full_time) / self.tile_time))
+            else:
+                self.tile_count = 1
+            for i in (hot + cold)[:self.tile_count]:
+                x, y, w, h = tiles[i]
+                start_time = time.time()
+                results.append(self.detect(frame[y:y+h, x:x+w], (x, y), apply_nms=False))
+                tile_time = time.time() - start_time
+                self.tile_time = 0.8 * self.tile_time + 0.2 * tile_time if self.tile_time else tile_time
+                if i in cold:
+                    self.tile_cursor += 1
+
+        boxes = np.concatenate([result[0] for result in results])
+        scores = np.concatenate([result[1] for result in results])
+        class_ids = np.concatenate([result[2] for result in results])
+        if not len(scores):
+            return boxes, scores, class_ids
+        # cross tile merge
+        keep = batched_nms(boxes, scores, class_ids, self.iou_threshold, 0.8)
+        return boxes[keep], scores[keep], class_ids[keep]
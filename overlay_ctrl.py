@@ -0,0 +1,139 @@
+import cv2
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+def blend_rect(frame, pt1, pt2, color, alpha):
+    # blends a solid color into one rectangle of the frame, in place
+    x1, y1 = max(0, pt1[0]), max(0, pt1[1])
+    x2, y2 = min(frame.shape[1], pt2[0]), min(frame.shape[0], pt2[1])
+    if x2 <= x1 or y2 <= y1:
+        return
+    roi = frame[y1:y2, x1:x2]
+    cv2.convertScaleAbs(roi, roi, 1 - alpha, 0)
+    if any(color):
+        cv2.add(roi, tuple(c * alpha for c in color) + (0,) * (4 - len(color)), roi)
+
+
+class TextSprite():
+    """One line of text rendered once into a small image and mask,
+    drawn afterwards with a masked copy into the frame roi."""
+    def __init__(self, text, font_scale, color, thickness=1, font=cv2.FONT_HERSHEY_SIMPLEX):
+        (width, height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+        # org of putText is the baseline, top is the offset from there to the sprite's first row
+        self.top = -(height + thickness)
+        sprite_h, sprite_w = height + baseline + 2 * thickness, width + 2 * thickness
+        self.image = np.zeros((sprite_h, sprite_w, 3), dtype=np.uint8)
+        mask = np.zeros((sprite_h, sprite_w), dtype=np.uint8)
+        cv2.putText(self.image, text, (0, -self.top), font, font_scale, color, thickness)
+        cv2.putText(mask, text, (0, -self.top), font, font_scale, 255, thickness)
+        self.mask = mask
+        self.image_bgra = None
+
+    def render(self, frame, org):
+        x, y = int(org[0]), int(org[1]) + self.top
+        h, w = self.image.shape[:2]
+        x1, y1 = max(0, x), max(0, y)
+        x2, y2 = min(frame.shape[1], x + w), min(frame.shape[0], y + h)
+        if x2 <= x1 or y2 <= y1:
+            return
+        image = self.image
+        if frame.shape[2] == 4:
+            if self.image_bgra is None:
+                self.image_bgra = cv2.cvtColor(self.image, cv2.COLOR_BGR2BGRA)
+            image = self.image_bgra
+        # writes into the frame roi in place, only where the mask is set
+        cv2.copyTo(image[y1-y:y2-y, x1-x:x2-x], self.mask[y1-y:y2-y, x1-x:x2-x], frame[y1:y2, x1:x2])
+
+
+class SpriteCache():
+    """Text sprites by (text, scale, color, thickness), the least recently
+    drawn dropped first, so constant hud labels outlive one-off lines."""
+    def __init__(self, max_sprites=256):
+        self.max_sprites = max_sprites
+        self.sprites = OrderedDict()
+        self.lock = threading.Lock()
+        self.renders = 0
+
+    def get(self, text, font_scale, color, thickness=1):
+        key = (text, font_scale, tuple(color), thickness)
+        with self.lock:
+            sprite = self.sprites.get(key)
+            if sprite is not None:
+                self.sprites.move_to_end(key)
+                return sprite
+        # rendered outside the lock, a race only renders the same sprite twice
+        sprite = TextSprite(text, font_scale, color, thickness)
+        with self.lock:
+            self.renders += 1
+            self.sprites[key] = sprite
+            self.sprites.move_to_end(key)
+            while len(self.sprites) > self.max_sprites:
+                self.sprites.popitem(last=False)
+        return sprite
+
+
+# shared by every overlay and hud layer
+sprite_cache = SpriteCache()
+
+
+def draw_text(frame, text, org, font_scale, color, thickness=1):
+    # cached replacement for cv2.putText with FONT_HERSHEY_SIMPLEX
+    sprite_cache.get(str(text), font_scale, color, thickness).render(frame, org)
+
+
+def draw_text_lines(frame, lines, org, font_scale, color, thickness=1, line_step=20):
+    # one sprite per line, a scrolling list only renders its new line
+    for i, line in enumerate(lines):
+        draw_text(frame, line, (org[0], org[1] + i * line_step), font_scale, color, thickness)
+
+
+class OverlayCanvas():
+    """Drawing primitives recorded by a detector and replayed onto the
+    output frame, nothing full-size is allocated, copied or blended."""
+    def __init__(self):
+        self.ops = []
+
+    def rectangle(self, *args, **kwargs):
+        self.ops.append((cv2.rectangle, args, kwargs))
+
+    def circle(self, *args, **kwargs):
+        self.ops.append((cv2.circle, args, kwargs))
+
+    def line(self, *args, **kwargs):
+        self.ops.append((cv2.line, args, kwargs))
+
+    def putText(self, *args, **kwargs):
+        self.ops.append((cv2.putText, args, kwargs))
+
+    def text(self, text, org, font_scale, color, thickness=1):
+        self.ops.append((draw_text, (text, org, font_scale, color, thickness), {}))
+
+    def text_lines(self, lines, org, font_scale, color, thickness=1, line_step=20):
+        self.ops.append((draw_text_lines, (lines, org, font_scale, color, thickness, line_step), {}))
+
+    def draw(self, func, *args, **kwargs):
+        # func(frame, *args, **kwargs), e.g. mediapipe drawing utils
+        self.ops.append((func, args, kwargs))
+
+    def fill_mask(self, mask, color):
+        # paints the non-zero pixels of a single channel mask, limited to their bounding rect
+        x, y, w, h = cv2.boundingRect(mask)
+        if w and h:
+            self.ops.append((self.paint_mask, (mask[y:y+h, x:x+w], x, y, color), {}))
+
+    @staticmethod
+    def paint_mask(frame, mask_roi, x, y, color):
+        h, w = mask_roi.shape[:2]
+        frame[y:y+h, x:x+w][mask_roi > 0] = color[:frame.shape[2]] + (0,) * (frame.shape[2] - len(color))
+
+    def copy(self):
+        canvas = OverlayCanvas()
+        canvas.ops = list(self.ops)
+        return canvas
+
+    def render(self, frame):
+        for func, args, kwargs in self.ops:
+            func(frame, *args, **kwargs)
+        return frame
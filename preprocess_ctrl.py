@@ -0,0 +1,83 @@
+import cv2
+
+
+class FrameContext():
+    """Derived images of one frame, each computed on first use and then
+    shared by every detector working on the same frame. scale picks a
+    downscaled level, 0.5 is half width and half height."""
+    def __init__(self, frame, seq=0, frame_time=0):
+        self.frame = frame
+        self.seq = seq
+        self.frame_time = frame_time
+        self.height, self.width = frame.shape[:2]
+        self.cache = {}
+
+    def cached(self, key, compute):
+        image = self.cache.get(key)
+        if image is None:
+            image = compute()
+            self.cache[key] = image
+        return image
+
+    def size(self, scale=1):
+        return max(1, round(self.width * scale)), max(1, round(self.height * scale))
+
+    def bgr(self, scale=1):
+        if scale == 1:
+            # csi frames come as XRGB8888, drop the fourth channel once
+            if self.frame.ndim == 3 and self.frame.shape[2] == 4:
+                return self.cached(('bgr', 1), lambda: cv2.cvtColor(self.frame, cv2.COLOR_BGRA2BGR))
+            return self.frame
+        return self.cached(('bgr', scale), lambda: cv2.resize(self.bgr(1), self.size(scale), interpolation=cv2.INTER_AREA))
+
+    def gray(self, scale=1):
+        return self.cached(('gray', scale), lambda: cv2.cvtColor(self.bgr(scale), cv2.COLOR_BGR2GRAY))
+
+    def rgb(self, scale=1):
+        return self.cached(('rgb', scale), lambda: cv2.cvtColor(self.bgr(scale), cv2.COLOR_BGR2RGB))
+
+    def hsv(self, scale=1, ksize=0):
+        # ksize blurs the bgr image first
+        return self.cached(('hsv', scale, ksize), lambda: cv2.cvtColor(self.blurred('bgr', ksize, scale), cv2.COLOR_BGR2HSV))
+
+    def blurred(self, source, ksize, scale=1):
+        # source is 'bgr' or 'gray', ksize 0 returns the source itself
+        image = getattr(self, source)(scale)
+        if not ksize:
+            return image
+        return self.cached((source + '_blur', scale, ksize), lambda: cv2.GaussianBlur(image, (ksize, ksize), 0))
+
+
+class ChangeGate():
+    """Cheap change detection on a heavily downscaled frame, in front of
+    the expensive detectors. Works like the motion detector: a running
+    average of the blurred gray image, thresholded difference, contours.
+    check() returns the changed regions in full frame coordinates, an
+    empty list means the scene did not change."""
+    def __init__(self, scale=0.125, threshold=25, min_area=0.002, alpha=0.2):
+        self.scale = scale
+        self.threshold = threshold
+        # the smallest region that counts, as a fraction of the frame area
+        self.min_area = min_area
+        self.alpha = alpha
+        self.avg = None
+
+    def check(self, frame_ctx):
+        gray = frame_ctx.blurred('gray', 5, self.scale)
+        if self.avg is None or self.avg.shape != gray.shape:
+            self.avg = gray.astype('float32')
+            return [(0, 0, frame_ctx.width, frame_ctx.height)]
+        delta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg))
+        cv2.accumulateWeighted(gray, self.avg, self.alpha)
+
+        thresh = cv2.threshold(delta, self.threshold, 255, cv2.THRESH_BINARY)[1]
+        thresh = cv2.dilate(thresh, None, iterations=1)
+        cnts = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+        min_area = self.min_area * gray.shape[0] * gray.shape[1]
+        regions = []
+        for c in cnts:
+            if cv2.contourArea(c) < min_area:
+                continue
+            x, y, w, h = cv2.boundingRect(c)
+            regions.append((int(x / self.scale), int(y / self.scale), int(w / self.scale), int(h / self.scale)))
+        return regions
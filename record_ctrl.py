@@ -0,0 +1,321 @@
+import cv2
+import datetime
+import imageio
+import multiprocessing
+import os
+import queue
+import subprocess
+import threading
+import numpy as np
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+
+# libraries for csi camera
+try:
+    from picamera2.outputs import FfmpegOutput, CircularOutput
+except ImportError:
+    FfmpegOutput = None
+    CircularOutput = None
+
+
+def record_worker(command_queue, free_queue):
+    # runs in its own process, encodes whatever the pipeline hands over
+    writer = None
+    slots = []
+    frames = []
+    fps = 30
+    first_time = None
+    written = 0
+    generation = 0
+    while True:
+        cmd = command_queue.get()
+        try:
+            if cmd[0] == 'start':
+                _, filename, slot_names, shape, fps, generation = cmd
+                slots = [shared_memory.SharedMemory(name=slot_name) for slot_name in slot_names]
+                # the parent owns and unlinks the slots, attaching must not register them again
+                for slot in slots:
+                    resource_tracker.unregister(slot._name, 'shared_memory')
+                frames = [np.ndarray(shape, dtype=np.uint8, buffer=slot.buf) for slot in slots]
+                writer = imageio.get_writer(filename, fps=fps)
+                first_time = None
+                written = 0
+
+            elif cmd[0] == 'frame':
+                _, slot_index, timestamp = cmd
+                frame = frames[slot_index]
+                if frame.shape[2] == 4:
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGRA2RGB)
+                else:
+                    rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                # the slot is free again as soon as the frame is copied out
+                free_queue.put((generation, slot_index))
+
+            elif cmd[0] == 'jpeg':
+                # pre-event frames, encoded before the recording started
+                _, jpeg, timestamp = cmd
+                rgb = cv2.cvtColor(cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+                if rgb.shape[:2] != shape[:2]:
+                    rgb = cv2.resize(rgb, (shape[1], shape[0]))
+
+            if cmd[0] in ('frame', 'jpeg'):
+                # place the frame on the constant fps grid of the file by its capture time
+                if first_time is None:
+                    first_time = timestamp
+                target = int((timestamp - first_time) * fps) + 1
+                # a frame whose slot on the grid is already written is skipped,
+                # faster input than the file fps must not play in slow motion
+                if target > written:
+                    repeat = min(target - written, fps * 2)
+                    for i in range(repeat):
+                        writer.append_data(rgb)
+                    written = target
+
+            if cmd[0] == 'stop':
+                if writer:
+                    writer.close()
+                writer = None
+                frames = []
+                for slot in slots:
+                    slot.close()
+                slots = []
+
+            elif cmd[0] == 'exit':
+                break
+        except Exception as e:
+            print(f"[record_ctrl.record_worker] error: {e}")
+
+
+# the encoding worker process, shared by every recorder
+record_process = None
+record_command_queue = None
+record_free_queue = None
+
+
+def start_record_worker():
+    # forks the worker, call it before the app starts a thread or opens a device:
+    # a fork of a multithreaded process can deadlock on a lock held at fork time,
+    # and the child would inherit the camera and serial descriptors
+    global record_process, record_command_queue, record_free_queue
+    if record_process is not None:
+        return
+    ctx = multiprocessing.get_context('fork')
+    record_command_queue = ctx.Queue()
+    record_free_queue = ctx.Queue()
+    record_process = ctx.Process(target=record_worker, args=(record_command_queue, record_free_queue), daemon=True)
+    record_process.start()
+
+
+class PreEventBuffer():
+    """The last seconds of encoded frames, bounded in time and in bytes,
+    flushed to the start of the next recording."""
+    def __init__(self, seconds=5, max_bytes=16*1024*1024):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.frames = deque()
+        self.total_bytes = 0
+
+    def push(self, jpeg, timestamp):
+        if not self.seconds or jpeg is None:
+            return
+        with self.lock:
+            self.frames.append((timestamp, jpeg))
+            self.total_bytes += len(jpeg)
+            while self.frames and (timestamp - self.frames[0][0] > self.seconds or self.total_bytes > self.max_bytes):
+                self.total_bytes -= len(self.frames.popleft()[1])
+
+    def drain(self):
+        with self.lock:
+            frames = list(self.frames)
+            self.frames.clear()
+            self.total_bytes = 0
+        return frames
+
+    def clear(self):
+        self.drain()
+
+
+def remux_h264(h264_filename, mp4_filename, fps):
+    # the circular output writes a raw h264 stream, the web ui lists mp4 files
+    try:
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-r', str(fps), '-i', h264_filename,
+                        '-c', 'copy', mp4_filename], check=True)
+        os.remove(h264_filename)
+    except Exception as e:
+        print(f"[record_ctrl.remux_h264] error: {e}")
+
+
+class VideoRecorder():
+    """Video recording off the streaming path. Frames are copied into a
+    small pool of shared memory slots and encoded by a worker process;
+    when every slot is busy the frame is dropped and counted instead of
+    blocking the pipeline. With a Picamera2 the shared hardware H.264
+    encoder (stream_ctrl.SharedH264Encoder) records the camera stream
+    directly."""
+    def __init__(self, fps=30, slot_count=8, h264_encoder=None):
+        self.fps = fps
+        self.slot_count = slot_count
+        self.h264_encoder = h264_encoder if h264_encoder is not None and h264_encoder.available() else None
+        self.hw_circular = None
+        self.hw_filename = None
+        # the requested pre-event seconds, applied once a running recording stops
+        self.pre_event_seconds = 0
+
+        self.recording = False
+        self.generation = 0
+        self.shape = None
+        self.slots = []
+        self.frames = []
+        self.recorded_frames = 0
+        self.dropped_frames = 0
+
+        # the worker is normally started by the app before any thread runs
+        self.command_queue = None
+        self.free_queue = None
+        self.process = None
+        if self.h264_encoder is None:
+            start_record_worker()
+            self.command_queue = record_command_queue
+            self.free_queue = record_free_queue
+            self.process = record_process
+
+    def set_pre_event(self, seconds):
+        # hardware path only, the encoder keeps the last seconds in a circular output
+        if self.h264_encoder is None or CircularOutput is None:
+            return
+        self.pre_event_seconds = seconds
+        if not self.recording:
+            self.apply_pre_event()
+
+    def apply_pre_event(self):
+        if self.pre_event_seconds and self.hw_circular is None:
+            self.hw_circular = CircularOutput(buffersize=int(self.pre_event_seconds * self.fps))
+            self.h264_encoder.add_output('pre_event', self.hw_circular)
+        elif not self.pre_event_seconds and self.hw_circular is not None:
+            self.h264_encoder.remove_output('pre_event')
+            self.hw_circular = None
+
+    def start(self, filename, frame_shape, pre_event_frames=None):
+        if self.recording:
+            return
+        self.recorded_frames = 0
+        self.dropped_frames = 0
+
+        if self.h264_encoder is not None:
+            if self.hw_circular is not None:
+                # flushes the buffered seconds first, then keeps writing
+                self.hw_filename = filename
+                self.hw_circular.fileoutput = filename[:-len('.mp4')] + '.h264'
+                self.hw_circular.start()
+            else:
+                self.h264_encoder.add_output('record', FfmpegOutput(filename))
+            self.recording = True
+            return
+
+        self.generation += 1
+        self.shape = frame_shape
+        frame_size = int(np.prod(frame_shape))
+        self.slots = [shared_memory.SharedMemory(create=True, size=frame_size) for i in range(self.slot_count)]
+        self.frames = [np.ndarray(frame_shape, dtype=np.uint8, buffer=slot.buf) for slot in self.slots]
+        for i in range(self.slot_count):
+            self.free_queue.put((self.generation, i))
+        self.command_queue.put(('start', filename, [slot.name for slot in self.slots], frame_shape, self.fps, self.generation))
+        for timestamp, jpeg in pre_event_frames or []:
+            self.command_queue.put(('jpeg', jpeg, timestamp))
+        self.recording = True
+
+    def next_free_slot(self):
+        while True:
+            generation, slot_index = self.free_queue.get_nowait()
+            # slots handed back from an earlier recording are stale
+            if generation == self.generation:
+                return slot_index
+
+    def append(self, frame, timestamp):
+        if not self.recording or self.h264_encoder is not None:
+            return
+        if frame.shape != self.shape:
+            self.dropped_frames += 1
+            return
+        try:
+            slot_index = self.next_free_slot()
+        except queue.Empty:
+            self.dropped_frames += 1
+            return
+        self.frames[slot_index][:] = frame
+        self.command_queue.put(('frame', slot_index, timestamp))
+        self.recorded_frames += 1
+
+    def stop(self):
+        if not self.recording:
+            return
+        self.recording = False
+
+        if self.h264_encoder is not None:
+            try:
+                if self.hw_circular is not None:
+                    # back to buffering only, the raw stream is remuxed off the pipeline
+                    self.hw_circular.stop()
+                    h264_filename = self.hw_circular.fileoutput
+                    threading.Thread(target=remux_h264, args=(h264_filename, self.hw_filename, self.fps), daemon=True).start()
+                else:
+                    self.h264_encoder.remove_output('record')
+                # pre-event changes made during the recording
+                self.apply_pre_event()
+            except Exception as e:
+                print(f"[record_ctrl.VideoRecorder.stop] error: {e}")
+            return
+
+        self.command_queue.put(('stop',))
+        # the worker keeps its own mapping until it has finished the file
+        self.frames = []
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+        self.slots = []
+        print(f"recorded frames: {self.recorded_frames}, dropped frames: {self.dropped_frames}")
+
+    def status(self):
+        return {'rec': self.recording, 'frames': self.recorded_frames, 'dropped': self.dropped_frames, 'hw': self.h264_encoder is not None}
+
+
+class PhotoWriter():
+    """Writes already encoded jpeg bytes to the sd card on its own thread,
+    the pipeline only hands the bytes over. A burst is one queue item, so
+    it is never cut short by the queue limit."""
+    def __init__(self, photo_path, max_pending=64):
+        self.photo_path = photo_path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.dropped_photos = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def photo_filename(self, timestamp, suffix=''):
+        current_time = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d_%H-%M-%S")
+        return f'{self.photo_path}photo_{current_time}{suffix}.jpg'
+
+    def save(self, jpeg, timestamp, suffix=''):
+        photo_filename = self.photo_filename(timestamp, suffix)
+        try:
+            self.queue.put_nowait([(photo_filename, jpeg)])
+        except queue.Full:
+            self.dropped_photos += 1
+            print(f"[record_ctrl.PhotoWriter.save] queue full, dropped: {photo_filename}")
+
+    def save_burst(self, frames, suffix='_burst'):
+        # frames as (timestamp, jpeg), waits for a free slot instead of dropping
+        photos = [(self.photo_filename(timestamp, f'{suffix}{index:02d}'), jpeg) for index, (timestamp, jpeg) in enumerate(frames)]
+        if photos:
+            self.queue.put(photos)
+
+    def run(self):
+        while True:
+            photos = self.queue.get()
+            for photo_filename, jpeg in photos:
+                try:
+                    with open(photo_filename, 'wb') as photo_file:
+                        photo_file.write(jpeg)
+                    print(photo_filename)
+                except Exception as e:
+                    print(f"[record_ctrl.PhotoWriter.run] error: {e}")
@@ -0,0 +1,207 @@
+import subprocess
+import threading
+from collections import deque
+
+# libraries for csi camera
+try:
+    from picamera2.encoders import H264Encoder
+    from picamera2.outputs import FileOutput
+except ImportError:
+    H264Encoder = None
+    FileOutput = None
+
+
+class SharedH264Encoder():
+    """The hardware H.264 encoder of a Picamera2, shared by the live stream,
+    the recorder and the pre-event circular output. Each user attaches its
+    own output under a name, the encoder runs while any output is attached.
+    One encoder means one bitrate, it is set for the most demanding user."""
+    def __init__(self, picam2, bitrate=4000000, fps=30):
+        self.picam2 = picam2
+        self.bitrate = bitrate
+        self.fps = fps
+        self.lock = threading.Lock()
+        self.encoder = None
+        self.outputs = {}
+
+    def available(self):
+        return self.picam2 is not None and H264Encoder is not None
+
+    def add_output(self, name, output):
+        with self.lock:
+            if name in self.outputs:
+                self.detach(name)
+            self.outputs[name] = output
+            if self.encoder is None:
+                # keyframe once per second, stream fragments, the circular
+                # output and outputs joining later all start on one
+                self.encoder = H264Encoder(self.bitrate, repeat=True, iperiod=self.fps)
+                self.picam2.start_encoder(self.encoder, list(self.outputs.values()))
+            else:
+                output.start()
+                self.encoder.output = list(self.outputs.values())
+
+    def remove_output(self, name):
+        with self.lock:
+            self.detach(name)
+
+    def detach(self, name):
+        output = self.outputs.pop(name, None)
+        if output is None:
+            return
+        try:
+            if self.outputs:
+                self.encoder.output = list(self.outputs.values())
+                output.stop()
+            else:
+                # stops the last output as well
+                self.picam2.stop_encoder(self.encoder)
+                self.encoder = None
+        except Exception as e:
+            print(f"[stream_ctrl.SharedH264Encoder.detach] error: {e}")
+
+
+class H264Streamer():
+    """Feeds the Picamera2 hardware H.264 encoder into ffmpeg, which only
+    remuxes it into fragmented MP4. Clients get the init segment first and
+    then one fragment per GOP, slow clients skip to the newest fragment.
+    The encoder is shared with the hardware recorder."""
+    def __init__(self, h264_encoder, max_fragments=4):
+        self.h264_encoder = h264_encoder
+        self.fps = h264_encoder.fps
+        # serialises start and stop, taken before the condition, never inside it
+        self.lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.init_segment = None
+        self.fragments = deque(maxlen=max_fragments)
+        self.fragment_seq = 0
+        self.clients = 0
+        self.running = False
+        # counts starts, a reader or client of an older ffmpeg leaves the current one alone
+        self.generation = 0
+        self.ffmpeg = None
+        self.reader_thread = None
+
+    def available(self):
+        return self.h264_encoder.available()
+
+    def start(self):
+        with self.lock:
+            if self.running or not self.available():
+                return
+            ffmpeg = subprocess.Popen(
+                ['ffmpeg', '-loglevel', 'error', '-f', 'h264', '-r', str(self.fps), '-i', '-',
+                 '-c:v', 'copy', '-f', 'mp4',
+                 '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            with self.condition:
+                self.generation += 1
+                self.ffmpeg = ffmpeg
+                self.init_segment = None
+                self.fragments.clear()
+                self.running = True
+            self.h264_encoder.add_output('stream', FileOutput(ffmpeg.stdin))
+            self.reader_thread = threading.Thread(target=self.read_boxes, args=(ffmpeg, self.generation), daemon=True)
+            self.reader_thread.start()
+            print("h264 stream started.")
+
+    def stop(self, generation=None, idle_only=False):
+        # generation stops only that stream, idle_only only without clients
+        with self.lock:
+            with self.condition:
+                if not self.running:
+                    return
+                if generation is not None and generation != self.generation:
+                    return
+                if idle_only and self.clients > 0:
+                    return
+                self.running = False
+                ffmpeg = self.ffmpeg
+                self.init_segment = None
+                self.fragments.clear()
+                self.condition.notify_all()
+            self.h264_encoder.remove_output('stream')
+            try:
+                ffmpeg.stdin.close()
+                ffmpeg.wait(timeout=2)
+            except Exception:
+                ffmpeg.kill()
+            print("h264 stream stopped.")
+
+    def read_box(self, stream):
+        header = stream.read(8)
+        if len(header) < 8:
+            return None, None
+        size = int.from_bytes(header[:4], 'big')
+        box_type = header[4:8]
+        if size == 1:
+            large_size = stream.read(8)
+            header += large_size
+            size = int.from_bytes(large_size, 'big')
+        if size < len(header):
+            # size 0 (to the end of the file) or garbage, a live stream has neither
+            return None, None
+        body = stream.read(size - len(header))
+        return box_type, header + body
+
+    def read_boxes(self, ffmpeg, generation):
+        stdout = ffmpeg.stdout
+        init_boxes = b''
+        moof = b''
+        while self.running and self.generation == generation:
+            box_type, box = self.read_box(stdout)
+            if box is None:
+                break
+            if box_type in (b'ftyp', b'moov'):
+                init_boxes += box
+                if box_type == b'moov':
+                    with self.condition:
+                        if self.generation == generation:
+                            self.init_segment = init_boxes
+                            self.condition.notify_all()
+            elif box_type == b'moof':
+                moof = box
+            elif box_type == b'mdat':
+                with self.condition:
+                    if self.generation == generation:
+                        self.fragments.append(moof + box)
+                        self.fragment_seq += 1
+                        self.condition.notify_all()
+                moof = b''
+        # ffmpeg went away on its own, release the encoder as well,
+        # unless a newer stream has taken over meanwhile
+        self.stop(generation)
+
+    def generate(self):
+        with self.condition:
+            self.clients += 1
+        try:
+            self.start()
+            with self.condition:
+                self.condition.wait_for(lambda: self.init_segment is not None or not self.running, 5)
+                init_segment = self.init_segment
+                generation = self.generation
+                last_seq = self.fragment_seq
+            if init_segment is None:
+                return
+            yield init_segment
+            # fragments of a restarted stream do not fit this init segment
+            while self.running and self.generation == generation:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.fragment_seq != last_seq or not self.running, 2)
+                    if self.generation != generation:
+                        break
+                    behind = self.fragment_seq - last_seq
+                    if behind <= 0:
+                        continue
+                    # a client too far behind jumps to the newest fragment
+                    behind = min(behind, len(self.fragments))
+                    pending = list(self.fragments)[-behind:]
+                    last_seq = self.fragment_seq
+                for fragment in pending:
+                    yield fragment
+        finally:
+            with self.condition:
+                self.clients -= 1
+            # a client that joined meanwhile keeps the stream
+            self.stop(idle_only=True)
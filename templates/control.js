@@ -6,7 +6,7 @@ var zoom_x1, zoom_x2, zoom_x4;
 var pic_cap, vid_sta, vid_end;
 var mc_lock, mc_unlo;
 var cv_none, cv_moti, cv_face, cv_objs, cv_clor, mp_hand, cv_auto;
-var mp_face, mp_pose;
+var mp_face, mp_pose, cv_fire;
 var re_none, re_capt, re_reco, led_off, led_aut, led_ton, base_of, base_on;
 var head_ct, base_ct;
 var s_panid, release, set_mid, s_tilid;
@@ -71,6 +71,7 @@ fetch('/config')
       cv_auto = yamlObject.code.cv_auto;
       mp_face = yamlObject.code.mp_face;
       mp_pose = yamlObject.code.mp_pose;
+      cv_fire = yamlObject.code.cv_fire;
 
       re_none = yamlObject.code.re_none;
       re_capt = yamlObject.code.re_capt;
@@ -94,6 +95,7 @@ fetch('/config')
       lidar_off = yamlObject.code.lidar_off;
 
       detect_type = yamlObject.fb.detect_type;
+      h264_web_feed = yamlObject.video.h264_web_feed;
       led_mode    = yamlObject.fb.led_mode;
       detect_react= yamlObject.fb.detect_react;
       picture_size= yamlObject.fb.picture_size;
@@ -599,6 +601,69 @@ socketJson.emit('json', {'T':1,'L':0,'R':0})
 var socket = io('http://' + location.host + '/ctrl');
 socket.emit('request_data');
 
+// video feed, the hardware h264 stream (csi camera) while no detection
+// overlay is drawn, the mjpeg stream otherwise or when h264 fails
+var h264_web_feed = false;
+var h264_feed_failed = false;
+var h264_feed_timer = null;
+
+function selectVideoFeed(useH264) {
+    var img = document.getElementById("mjpeg_feed");
+    var video = document.getElementById("h264_feed");
+    if (!img || !video) {
+        return;
+    }
+    if (useH264 && h264_web_feed && !h264_feed_failed) {
+        if (video.getAttribute("src")) {
+            return;
+        }
+        video.src = video.dataset.src;
+        video.play().catch(function() {});
+        // no picture in time, keep the mjpeg stream
+        h264_feed_timer = setTimeout(function() {
+            h264FeedFailed();
+        }, 5000);
+    } else {
+        clearTimeout(h264_feed_timer);
+        if (video.getAttribute("src")) {
+            video.removeAttribute("src");
+            video.load();
+        }
+        video.style.display = "none";
+        if (!img.getAttribute("src")) {
+            img.src = img.dataset.src;
+        }
+        img.style.display = "";
+    }
+}
+
+function h264FeedFailed() {
+    h264_feed_failed = true;
+    selectVideoFeed(false);
+}
+
+document.addEventListener("DOMContentLoaded", function() {
+    var img = document.getElementById("mjpeg_feed");
+    var video = document.getElementById("h264_feed");
+    if (!img || !video) {
+        return;
+    }
+    video.addEventListener("playing", function() {
+        clearTimeout(h264_feed_timer);
+        video.style.display = "";
+        // closes the mjpeg connection, the server stops encoding for it
+        img.removeAttribute("src");
+        img.style.display = "none";
+    });
+    // only while a source is set, removing it is not a failure
+    video.addEventListener("error", function() {
+        if (video.getAttribute("src")) h264FeedFailed();
+    });
+    video.addEventListener("ended", function() {
+        if (video.getAttribute("src")) h264FeedFailed();
+    });
+});
+
 var light_mode = 0;
 var cv_heartbeat_stop_flag = false;
 socket.on('update', function(data) {
@@ -607,6 +672,7 @@ socket.on('update', function(data) {
     } else {
         return;
     }
+    selectVideoFeed(data[detect_type] == cv_none);
     try {
         var baseBtn = document.getElementById("base_led_ctrl_btn");
         if (baseBtn) {
@@ -646,7 +712,7 @@ socket.on('update', function(data) {
             if (data[detect_type] == cv_none) {
                 dtIco.classList.add("feed_ico", "feed_ico_none");
                 DTbuttons[0].classList.add("ctl_btn_active");
-            } else if (data[detect_type] == cv_moti) {
+            } else if (data[detect_type] == cv_moti || data[detect_type] == cv_fire) {
                 dtIco.classList.add("feed_ico", "feed_ico_movtion");
                 DTbuttons[1].classList.add("ctl_btn_active");
             } else if (data[detect_type] == cv_face) {
@@ -1,33 +1,57 @@
+// WebRTC video, only used by pages that have a remoteVideo element
+const remoteVideo = document.getElementById("remoteVideo");
+
 // Create a new RTCPeerConnection instance
 let pc = new RTCPeerConnection();
 
-// Function to send an offer request to the server
+// Wait until all ICE candidates are part of the local description
+function waitIceGathering() {
+    if (pc.iceGatheringState === "complete") {
+        return Promise.resolve();
+    }
+    return new Promise((resolve) => {
+        pc.addEventListener("icegatheringstatechange", () => {
+            if (pc.iceGatheringState === "complete") {
+                resolve();
+            }
+        });
+    });
+}
+
+// Function to send an offer to the server and apply its answer
 async function createOffer() {
     console.log("Sending offer request");
 
-    // Fetch the offer from the server
-    const offerResponse = await fetch("/offer", {
+    // Receive only, the robot sends the video track
+    pc.addTransceiver("video", { direction: "recvonly" });
+    pc.addEventListener("track", (event) => {
+        remoteVideo.srcObject = event.streams[0] || new MediaStream([event.track]);
+    });
+
+    const offer = await pc.createOffer();
+    await pc.setLocalDescription(offer);
+    await waitIceGathering();
+
+    const answerResponse = await fetch("/offer", {
         method: "POST",
         headers: {
             "Content-Type": "application/json",
         },
         body: JSON.stringify({
-            sdp: "",
-            type: "offer",
+            sdp: pc.localDescription.sdp,
+            type: pc.localDescription.type,
         }),
     });
 
-    // Parse the offer response
-    const offer = await offerResponse.json();
-    console.log("Received offer response:", offer);
+    // Parse the answer response
+    const answer = await answerResponse.json();
+    console.log("Received answer response:", answer);
 
-    // Set the remote description based on the received offer
-    await pc.setRemoteDescription(new RTCSessionDescription(offer));
-
-    // Create an answer and set it as the local description
-    const answer = await pc.createAnswer();
-    await pc.setLocalDescription(answer);
+    // Set the remote description based on the received answer
+    await pc.setRemoteDescription(new RTCSessionDescription(answer));
 }
 
 // Trigger the process by creating and sending an offer
-createOffer();
+if (remoteVideo) {
+    createOffer();
+}
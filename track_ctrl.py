@@ -0,0 +1,177 @@
+import cv2
+import itertools
+import numpy as np
+
+
+def iou_matrix(boxes_a, boxes_b):
+    # pairwise iou of x1, y1, x2, y2 boxes
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+    w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = w * h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / (area_a + area_b - inter + 1e-9)
+
+
+def create_cv_tracker():
+    # kcf from opencv-contrib when installed, mil from the main package otherwise
+    for factory in ('TrackerKCF_create', 'legacy.TrackerKCF_create', 'TrackerMIL_create'):
+        module = cv2
+        for name in factory.split('.'):
+            module = getattr(module, name, None)
+            if module is None:
+                break
+        if module is not None:
+            return module()
+    return None
+
+
+class BoxKalman():
+    """Constant velocity kalman filter over the box center and size,
+    state cx, cy, w, h, vx, vy in pixels and pixels per second."""
+    def __init__(self, box, process_noise=50.0, measurement_noise=4.0):
+        cx, cy, w, h = self.to_state(box)
+        self.x = np.array([cx, cy, w, h, 0, 0], dtype=np.float64)
+        self.P = np.diag([10, 10, 10, 10, 1000, 1000]).astype(np.float64)
+        self.process_noise = process_noise
+        self.R = np.eye(4) * measurement_noise ** 2
+        self.H = np.eye(4, 6)
+
+    @staticmethod
+    def to_state(box):
+        x1, y1, x2, y2 = box
+        return (x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1
+
+    def predict(self, dt):
+        F = np.eye(6)
+        F[0, 4] = F[1, 5] = dt
+        Q = np.diag([dt, dt, dt, dt, 1, 1]) * self.process_noise * max(dt, 1e-3)
+        self.x = F @ self.x
+        self.P = F @ self.P @ F.T + Q
+
+    def update(self, box):
+        z = np.array(self.to_state(box))
+        y = z - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ y
+        self.P = (np.eye(6) - K @ self.H) @ self.P
+
+    def box(self):
+        cx, cy, w, h = self.x[:4]
+        return np.array([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2])
+
+
+class Track():
+    def __init__(self, track_id, box, score, class_id, frame_time):
+        self.track_id = track_id
+        self.kalman = BoxKalman(box)
+        self.score = score
+        self.class_id = class_id
+        self.hits = 1
+        self.last_time = frame_time
+        self.last_seen = frame_time
+        # the last frame time with a detection or a cv tracker measurement
+        self.last_measured = frame_time
+        self.cv_tracker = None
+
+    def box(self):
+        return self.kalman.box()
+
+    def center(self):
+        return int(self.kalman.x[0]), int(self.kalman.x[1])
+
+
+class MultiTracker():
+    """IoU association of detections to kalman tracks with stable ids.
+    update() takes the detections of a detector frame, predict() carries
+    the tracks over the frames in between, optionally measured with an
+    opencv correlation tracker on the frame."""
+    def __init__(self, iou_threshold=0.3, max_age=1.0, min_hits=2, use_cv_tracker=False):
+        self.iou_threshold = iou_threshold
+        # seconds without a detection before a track is dropped
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.use_cv_tracker = use_cv_tracker
+        self.tracks = []
+        self.ids = itertools.count(1)
+
+    def advance(self, frame_time):
+        for track in self.tracks:
+            track.kalman.predict(max(0, frame_time - track.last_time))
+            track.last_time = frame_time
+
+    def update(self, boxes, scores, class_ids, frame_time, frame=None):
+        self.advance(frame_time)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        unmatched = set(range(len(boxes)))
+        if self.tracks and len(boxes):
+            track_boxes = np.array([track.box() for track in self.tracks])
+            ious = iou_matrix(track_boxes, boxes)
+            # a fast target may not overlap its prediction any more, the center
+            # distance relative to the track size is the second chance
+            track_size = np.maximum(track_boxes[:, 2] - track_boxes[:, 0], track_boxes[:, 3] - track_boxes[:, 1])
+            track_centers = (track_boxes[:, :2] + track_boxes[:, 2:]) / 2
+            centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+            distances = np.linalg.norm(track_centers[:, None, :] - centers[None, :, :], axis=2) / (track_size[:, None] + 1e-9)
+            matched = set()
+            for cost, accept in ((-ious, lambda t, d: ious[t, d] >= self.iou_threshold),
+                                 (distances, lambda t, d: distances[t, d] <= 1.0)):
+                # greedy, best pair first, one detection per track
+                for flat in np.argsort(cost, axis=None):
+                    t, d = divmod(int(flat), len(boxes))
+                    if not accept(t, d):
+                        break
+                    if d not in unmatched or t in matched:
+                        continue
+                    unmatched.discard(d)
+                    matched.add(t)
+                    track = self.tracks[t]
+                    track.kalman.update(boxes[d])
+                    track.score, track.class_id = scores[d], class_ids[d]
+                    track.hits += 1
+                    track.last_seen = frame_time
+                    track.last_measured = frame_time
+                    self.init_cv_tracker(track, boxes[d], frame)
+        for d in sorted(unmatched):
+            track = Track(next(self.ids), boxes[d], scores[d], class_ids[d], frame_time)
+            self.init_cv_tracker(track, boxes[d], frame)
+            self.tracks.append(track)
+        self.tracks = [track for track in self.tracks if frame_time - track.last_seen <= self.max_age]
+
+    def init_cv_tracker(self, track, box, frame):
+        if not self.use_cv_tracker or frame is None:
+            return
+        track.cv_tracker = create_cv_tracker()
+        if track.cv_tracker is not None:
+            x1, y1, x2, y2 = [int(v) for v in box]
+            track.cv_tracker.init(frame, (x1, y1, max(1, x2 - x1), max(1, y2 - y1)))
+
+    def predict(self, frame_time, frame=None):
+        self.advance(frame_time)
+        if not self.use_cv_tracker or frame is None:
+            return
+        for track in self.tracks:
+            if track.cv_tracker is None:
+                continue
+            ok, (x, y, w, h) = track.cv_tracker.update(frame)
+            if ok:
+                track.kalman.update((x, y, x + w, y + h))
+                track.last_measured = frame_time
+            else:
+                track.cv_tracker = None
+
+    def confirmed(self):
+        return [track for track in self.tracks if track.hits >= self.min_hits]
+
+    def primary(self):
+        # the largest confirmed track, what the gimbal follows
+        tracks = self.confirmed()
+        if not tracks:
+            return None
+        return max(tracks, key=lambda track: track.kalman.x[2] * track.kalman.x[3])
+
+    def clear(self):
+        self.tracks = []